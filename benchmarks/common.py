@@ -0,0 +1,59 @@
+"""Helpers shared by the benchmarks: random parents, random recipes and timing.
+
+Every benchmark runs offline on randomly initialized GPT-2 parents named like
+the real ones, so recipes built here are valid for ``merge_models`` once the
+parents are installed (see ``benchmarks.suite.install_parents``).
+"""
+
+import time
+
+import torch
+from transformers import GPT2LMHeadModel
+
+from evolutiontransformer.store import LayerStack
+
+MODEL_NAMES = ["svamp", "tinystories"]
+
+
+def timed(fn, repeat):
+    """Best wall-clock time of ``repeat`` calls to ``fn``, in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def build_parents(config, dtype=torch.float32):
+    """Random parents in ``dtype``, with their blocks packed into a LayerStack."""
+    torch.manual_seed(0)
+    models = {
+        name: GPT2LMHeadModel(config).to(dtype).eval().requires_grad_(False)
+        for name in MODEL_NAMES
+    }
+    stack = LayerStack(
+        MODEL_NAMES, models[MODEL_NAMES[0]].transformer.h[0], config.n_layer, dtype
+    )
+    for name, model in models.items():
+        stack.pack(name, model)
+    return models, stack
+
+
+def random_layer(terms, base_layers, rnd):
+    return [
+        (rnd.randrange(base_layers), rnd.choice(MODEL_NAMES), rnd.uniform(0.1, 0.9))
+        for _ in range(terms)
+    ]
+
+
+def random_layer_recipe(depth, terms, base_layers, rnd):
+    return [random_layer(terms, base_layers, rnd) for _ in range(depth)]
+
+
+def random_recipe(depth, terms, base_layers, rnd):
+    return {
+        "layer_recipe": random_layer_recipe(depth, terms, base_layers, rnd),
+        "embedding_lambdas": [rnd.random(), rnd.random()],
+        "linear_lambdas": [rnd.random(), rnd.random()],
+    }
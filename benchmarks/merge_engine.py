@@ -0,0 +1,72 @@
+"""Compare the per-key merge loop with the packed LayerStack merge.
+
+Runs offline on randomly initialized GPT-2 parents, e.g.
+
+    uv run python -m benchmarks.merge_engine --base-layers 24 --depth 48 --terms 3
+"""
+
+import argparse
+import random
+
+import torch
+from transformers import GPT2Config
+
+from benchmarks.common import build_parents, random_layer_recipe, timed
+
+
+def loop_merge_layer(base_models, recipe):
+    """The original merge_models.merge_layer, kept here as the baseline."""
+
+    def get_model_layer(layer, model):
+        return model.transformer.h[layer].state_dict()
+
+    base = get_model_layer(recipe[0][0], base_models[recipe[0][1]])
+    for key in base.keys():
+        base[key] = recipe[0][2] * base[key]
+    for layer in recipe[1:]:
+        layer_data = get_model_layer(layer[0], base_models[layer[1]])
+        for key in base.keys():
+            base[key] += layer[2] * layer_data[key]
+    return base
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n-embd", type=int, default=1024)
+    parser.add_argument("--n-head", type=int, default=16)
+    parser.add_argument("--base-layers", type=int, default=12)
+    parser.add_argument("--depth", type=int, default=24)
+    parser.add_argument("--terms", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    config = GPT2Config(
+        n_embd=args.n_embd, n_head=args.n_head, n_layer=args.base_layers
+    )
+    base_models, stack = build_parents(config)
+    layer_recipe = random_layer_recipe(
+        args.depth, args.terms, args.base_layers, random.Random(0)
+    )
+
+    with torch.no_grad():
+        loop = timed(
+            lambda: [loop_merge_layer(base_models, layer) for layer in layer_recipe],
+            args.repeat,
+        )
+        stacked = timed(lambda: stack.merge_layers(layer_recipe), args.repeat)
+
+        expected = loop_merge_layer(base_models, layer_recipe[0])
+        actual = stack.layer_state_dict(stack.merge_layers(layer_recipe[:1])[0])
+        for key, value in expected.items():
+            torch.testing.assert_close(actual[key], value)
+
+    print(
+        f"depth={args.depth} terms={args.terms} "
+        f"layer_params={stack.numel:,} threads={torch.get_num_threads()}"
+    )
+    print(f"per-key loop : {loop * 1000:9.1f} ms")
+    print(f"LayerStack   : {stacked * 1000:9.1f} ms  ({loop / stacked:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Compare fp32 and bf16 weight storage for merging and CPU generation.
+
+Runs offline on randomly initialized GPT-2 parents, e.g.
+
+    uv run python -m benchmarks.precision --base-layers 24 --depth 24 --terms 3
+
+bf16 merges accumulate in fp32 (see ``LayerStack.merge_layers``); the error
+column is the largest difference from an all-fp32 merge.
+"""
+
+import argparse
+import random
+
+import torch
+from transformers import GPT2Config
+
+from benchmarks.common import MODEL_NAMES, build_parents, random_layer_recipe, timed
+from evolutiontransformer.cache import model_nbytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n-embd", type=int, default=1024)
+    parser.add_argument("--n-head", type=int, default=16)
+    parser.add_argument("--base-layers", type=int, default=12)
+    parser.add_argument("--depth", type=int, default=24)
+    parser.add_argument("--terms", type=int, default=2)
+    parser.add_argument("--new-tokens", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    config = GPT2Config(
+        n_embd=args.n_embd, n_head=args.n_head, n_layer=args.base_layers
+    )
+    layer_recipe = random_layer_recipe(
+        args.depth, args.terms, args.base_layers, random.Random(0)
+    )
+    input_ids = torch.randint(0, config.vocab_size, (1, 32))
+
+    print(
+        f"depth={args.depth} terms={args.terms} new_tokens={args.new_tokens} "
+        f"threads={torch.get_num_threads()}"
+    )
+    reference = None
+    for dtype in (torch.float32, torch.bfloat16):
+        models, stack = build_parents(config, dtype)
+        with torch.no_grad():
+            merge = timed(lambda: stack.merge_layers(layer_recipe), args.repeat)
+            merged = torch.stack(stack.merge_layers(layer_recipe)).float()
+            if reference is None:
+                reference = merged
+            error = (merged - reference).abs().max().item()
+
+            model = models[MODEL_NAMES[0]]
+            generate = timed(
+                lambda: model.generate(
+                    input_ids,
+                    attention_mask=torch.ones_like(input_ids),
+                    max_new_tokens=args.new_tokens,
+                    min_new_tokens=args.new_tokens,
+                    do_sample=False,
+                    pad_token_id=0,
+                ),
+                args.repeat,
+            )
+
+        mib = sum(model_nbytes(m) for m in models.values()) / (1024 * 1024)
+        print(
+            f"{str(dtype):15s}: parents {mib:8.1f} MiB  merge {merge * 1000:8.1f} ms  "
+            f"max error {error:.2e}  {args.new_tokens / generate:7.1f} tok/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Compare fp32 and int8 dynamically quantized children for CPU generation.
+
+Runs offline on a randomly initialized GPT-2, e.g.
+
+    uv run python -m benchmarks.quantization --layers 24 --new-tokens 64
+
+Accuracy needs the real parents; see test_quantized_model_accuracy in
+tests/test_model_actions.py.
+"""
+
+import argparse
+
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from benchmarks.common import timed
+from evolutiontransformer.cache import model_nbytes
+from evolutiontransformer.quantize import quantize_model
+
+
+def tokens_per_second(model, input_ids, new_tokens, repeat):
+    seconds = timed(
+        lambda: model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=new_tokens,
+            min_new_tokens=new_tokens,
+            do_sample=False,
+            pad_token_id=0,
+        ),
+        repeat,
+    )
+    return new_tokens / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n-embd", type=int, default=1024)
+    parser.add_argument("--n-head", type=int, default=16)
+    parser.add_argument("--layers", type=int, default=24)
+    parser.add_argument("--prompt-tokens", type=int, default=32)
+    parser.add_argument("--new-tokens", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    config = GPT2Config(n_embd=args.n_embd, n_head=args.n_head, n_layer=args.layers)
+    model = GPT2LMHeadModel(config).eval().requires_grad_(False)
+    quantized = quantize_model(model)
+
+    input_ids = torch.randint(0, config.vocab_size, (1, args.prompt_tokens))
+    with torch.no_grad():
+        fp32 = tokens_per_second(model, input_ids, args.new_tokens, args.repeat)
+        int8 = tokens_per_second(quantized, input_ids, args.new_tokens, args.repeat)
+
+        logits = model(input_ids).logits
+        q_logits = quantized(input_ids).logits
+        agreement = (logits.argmax(-1) == q_logits.argmax(-1)).float().mean()
+
+    mib = 1024 * 1024
+    fp32_blocks = model_nbytes(model.transformer.h) / mib
+    int8_blocks = model_nbytes(quantized.transformer.h) / mib
+    print(
+        f"layers={args.layers} prompt={args.prompt_tokens} "
+        f"new_tokens={args.new_tokens} threads={torch.get_num_threads()}"
+    )
+    print(f"fp32 : {fp32:7.1f} tok/s  blocks {fp32_blocks:8.1f} MiB")
+    print(
+        f"int8 : {int8:7.1f} tok/s  blocks {int8_blocks:8.1f} MiB  "
+        f"({int8 / fp32:.1f}x speed, {fp32_blocks / int8_blocks:.1f}x smaller)"
+    )
+    print(f"greedy next-token agreement: {agreement:.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""Time the merge and generation hot paths and print the results as JSON.
+
+Runs offline: the parents are small randomly initialized GPT-2s installed in
+place of the hub checkpoints, so numbers track code changes, not the real
+model size. Compare runs between commits, e.g.
+
+    uv run python -m benchmarks.suite --output bench-$(git rev-parse --short HEAD).json
+
+Generation is timed on token ids, so tokenization (a fixed, small cost that
+needs the hub tokenizer) is not included.
+"""
+
+import argparse
+import contextlib
+import json
+import random
+import resource
+import subprocess
+import sys
+
+import torch
+from transformers import GPT2Config
+
+from benchmarks.common import MODEL_NAMES, build_parents, random_recipe, timed
+from evolutiontransformer import worker
+from evolutiontransformer.recipes import base_model_recipe, merge_model_recipe
+
+BENCH_CONFIG = "benchmark"
+
+
+def peak_rss_mib() -> float:
+    # ru_maxrss is in KiB on Linux and bytes on macOS.
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def install_parents(config):
+    """Put random parents where ``merge_models`` looks for the real ones."""
+    models, stack = build_parents(config)
+    worker.BASE_MODELS.clear()
+    worker.BASE_MODELS.update(models)
+    worker.LAYER_STACK = stack
+    worker.BASE_CONFIGS[BENCH_CONFIG] = config
+    # Every timed merge must build its blocks rather than hit the block cache.
+    worker.BLOCK_CACHE.max_bytes = 0
+
+
+def bench_merge_model_recipe(base_layers, repeat):
+    rnd = random.Random(0)
+    parent1 = base_model_recipe(MODEL_NAMES[0])
+    parent2 = base_model_recipe(MODEL_NAMES[1])
+    layer_recipe = [
+        [(rnd.randrange(base_layers), rnd.randrange(2), rnd.random()) for _ in range(4)]
+        for _ in range(48)
+    ]
+    calls = 100
+    seconds = timed(
+        lambda: [
+            merge_model_recipe(parent1, parent2, layer_recipe) for _ in range(calls)
+        ],
+        repeat,
+    )
+    return {"depth": 48, "terms": 4, "seconds": seconds / calls}
+
+
+def bench_merge_models(depths, max_terms, base_layers, repeat):
+    rnd = random.Random(0)
+    results = []
+    for depth in depths:
+        for terms in range(1, max_terms + 1):
+            recipe = random_recipe(depth, terms, base_layers, rnd)
+            seconds = timed(
+                lambda: worker.merge_models(recipe, base_model=BENCH_CONFIG), repeat
+            )
+            results.append({"depth": depth, "terms": terms, "seconds": seconds})
+    return results
+
+
+def bench_generation(config, prompt_tokens, new_tokens, repeat):
+    model = worker.merge_models(
+        random_recipe(config.n_layer, 2, config.n_layer, random.Random(0)),
+        base_model=BENCH_CONFIG,
+    )
+    input_ids = torch.randint(0, config.vocab_size, (1, prompt_tokens))
+    attention_mask = torch.ones_like(input_ids)
+
+    def generate():
+        model.generate(
+            input_ids,
+            attention_mask=attention_mask,
+            max_new_tokens=new_tokens,
+            min_new_tokens=new_tokens,
+            do_sample=False,
+            pad_token_id=0,
+        )
+
+    with torch.no_grad():
+        prefill = timed(lambda: model(input_ids, attention_mask=attention_mask), repeat)
+        total = timed(generate, repeat)
+    # generate runs the prefill once, then one step per token after the first.
+    decode = max(total - prefill, 1e-9)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "new_tokens": new_tokens,
+        "prefill_tokens_per_s": prompt_tokens / prefill,
+        "decode_tokens_per_s": max(new_tokens - 1, 1) / decode,
+    }
+
+
+def run(args):
+    config = GPT2Config(
+        n_embd=args.n_embd, n_head=args.n_head, n_layer=args.base_layers
+    )
+    install_parents(config)
+
+    results = {
+        "commit": git_commit(),
+        "torch": torch.__version__,
+        "threads": torch.get_num_threads(),
+        "config": vars(args),
+        "peak_rss_mib": {"parents": peak_rss_mib()},
+    }
+    results["merge_model_recipe"] = bench_merge_model_recipe(
+        args.base_layers, args.repeat
+    )
+    results["merge_models"] = bench_merge_models(
+        args.depths, args.max_terms, args.base_layers, args.repeat
+    )
+    results["peak_rss_mib"]["merge"] = peak_rss_mib()
+    results["generation"] = bench_generation(
+        config, args.prompt_tokens, args.new_tokens, args.repeat
+    )
+    results["peak_rss_mib"]["generation"] = peak_rss_mib()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n-embd", type=int, default=256)
+    parser.add_argument("--n-head", type=int, default=4)
+    parser.add_argument("--base-layers", type=int, default=24)
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 6, 12, 24, 48])
+    parser.add_argument("--max-terms", type=int, default=4)
+    parser.add_argument("--prompt-tokens", type=int, default=128)
+    parser.add_argument("--new-tokens", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    # The worker logs to stdout as it merges; keep stdout for the JSON alone.
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run(args)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,18 +2,76 @@ import os
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+import asyncio
+import base64
+import json
+import math
 import uuid
-from typing import List, Tuple
-from fastapi import FastAPI, Depends, HTTPException, Request, Response
+from typing import List, Optional, Tuple
+import anyio
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, StreamingResponse
 from pydantic import BaseModel
-from celery import Celery
+from celery import Celery, states
+from kombu.serialization import dumps
 from dotenv import load_dotenv
+from evolutiontransformer.redis import (
+    async_admit_task,
+    async_allocate_model_name,
+    async_cancel_task,
+    async_claim_response,
+    async_delete_session,
+    async_get_model_recipe_default,
+    async_get_session_models,
+    async_redis_client,
+    async_get_ready_workers,
+    async_is_task_admitted,
+    async_is_task_cancelled,
+    async_release_task,
+    response_key,
+    stream_channel,
+)
+from evolutiontransformer.recipes import (
+    BASE_MODELS_NAMES,
+    MAX_LAYERS,
+    merge_model_recipe,
+    recipe_hash,
+)
 
 load_dotenv()
 
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Where the worker writes exports; shared with it (same machine or volume).
+EXPORT_DIR = os.getenv(
+    "EXPORT_DIR",
+    os.path.join(
+        os.getenv("HF_HOME", os.path.expanduser("~/.cache")),
+        "evolutiontransformer",
+        "exports",
+    ),
+)
+EXPORT_FILES = ("config.json", "model.safetensors")
+# How long identical greedy requests share one task's result (0 disables).
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+# Inference tasks admitted but not finished, in total and per session.
+MAX_QUEUE_DEPTH = int(os.getenv("MAX_QUEUE_DEPTH", "32"))
+MAX_SESSION_INFLIGHT = int(os.getenv("MAX_SESSION_INFLIGHT", "2"))
+# Admitted tasks no worker has finished after this long are presumed lost.
+ADMISSION_STALE_SECONDS = int(os.getenv("ADMISSION_STALE_SECONDS", "900"))
+# Requests for at most this many new tokens go to the priority queue, which
+# workers drain first (0 disables it).
+PRIORITY_MAX_NEW_TOKENS = int(os.getenv("PRIORITY_MAX_NEW_TOKENS", "64"))
+PRIORITY_QUEUE = "priority"
+# A claimed task is admitted right after the claim; until then it is not stale.
+CLAIM_ADMIT_GRACE_SECONDS = 10
+DEFAULT_RETRY_AFTER_SECONDS = 30
+DISCONNECT_POLL_SECONDS = 1
+# How long a token stream may go quiet before the task is checked on and a
+# keepalive comment is sent, so proxies do not drop the connection.
+STREAM_IDLE_SECONDS = 15
+MAX_RETRY_AFTER_SECONDS = 300
 
 
 celery_app = Celery(
@@ -34,6 +92,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After"],
 )
 
 
@@ -44,6 +103,10 @@ class GenerateRequest(BaseModel):
     temperature: float = 0.7
 
 
+class ExportRequest(BaseModel):
+    model_name: str
+
+
 class MergeRequest(BaseModel):
     model1_name: str
     model2_name: str
@@ -53,14 +116,11 @@ class MergeRequest(BaseModel):
     merged_name: str = "merged"
 
 
-def get_session_id(request: Request, response: Response):
+async def get_session_id(request: Request, response: Response):
     session_id = request.cookies.get("session_id")
-    print(f"Received cookies: {request.cookies}")
-    print(f"Current session_id: {session_id}")
 
     if not session_id:
         session_id = str(uuid.uuid4())
-        print(f"Generated new session_id: {session_id}")
         response.set_cookie(
             key="session_id",
             value=session_id,
@@ -72,53 +132,450 @@ def get_session_id(request: Request, response: Response):
     return session_id
 
 
-@app.post("/generate")
-def generate(request: GenerateRequest, session_id: str = Depends(get_session_id)):
-    task = celery_app.send_task(
-        "tasks.inference",
-        args=[
+async def send_task(
+    name: str, args: list, task_id: str, queue: Optional[str] = None
+) -> None:
+    """Publish a task as ``celery_app.send_task`` would, on the async Redis pool.
+
+    The broker is the same Redis, where publishing is a single LPUSH of the
+    message onto the queue's list. Celery still builds the task message and
+    kombu serializes it; only the envelope of kombu's Redis transport is
+    written here, and a test compares it with the one kombu builds.
+    """
+    queue = queue or celery_app.conf.task_default_queue
+    message = celery_app.amqp.as_task_v2(task_id, name, args=args, kwargs={})
+    content_type, content_encoding, body = dumps(message.body, serializer="json")
+    if isinstance(body, str):
+        body = body.encode(content_encoding)
+    envelope = {
+        "body": base64.b64encode(body).decode("ascii"),
+        "content-encoding": content_encoding,
+        "content-type": content_type,
+        "headers": message.headers,
+        "properties": {
+            **message.properties,
+            "delivery_mode": 2,
+            "delivery_info": {"exchange": "", "routing_key": queue},
+            "priority": 0,
+            "body_encoding": "base64",
+            "delivery_tag": str(uuid.uuid4()),
+        },
+    }
+    await async_redis_client.lpush(queue, json.dumps(envelope))
+
+
+async def task_meta(task_id: str) -> Optional[dict]:
+    """The result backend's stored state for a task, or None while it is queued."""
+    meta = await async_redis_client.get(
+        celery_app.backend.get_key_for_task(task_id).decode()
+    )
+    return json.loads(meta) if meta else None
+
+
+async def claim_response(
+    request: GenerateRequest, session_id: str, task_id: str, attach: bool = True
+) -> Tuple[Optional[str], Optional[str]]:
+    """Share one task between identical deterministic requests.
+
+    With temperature 0 the recipe, prompt and max_new_tokens fully determine
+    the output. Returns ``(response key, task id)``: the id of a task already
+    queued, running or finished for the same request, or None once
+    ``task_id`` has been recorded as that task. Both are None for requests
+    that are not cached. Pass ``attach=False`` when a returned task would not
+    be waited on, so cancelling its other requests still cancels it.
+    """
+    if request.temperature > 0 or RESPONSE_CACHE_TTL_SECONDS <= 0:
+        return None, None
+    recipe = await async_get_model_recipe_default(session_id, request.model_name)
+    if recipe is None:
+        return None, None
+    key = response_key(recipe_hash(recipe), request.prompt, request.max_new_tokens)
+    existing = await async_claim_response(
+        key, task_id, session_id, RESPONSE_CACHE_TTL_SECONDS, attach=attach
+    )
+    if existing is not None and await is_stale_claim(key, existing):
+        existing = await async_claim_response(
+            key,
+            task_id,
             session_id,
-            request.model_name,
-            request.prompt,
-            request.max_new_tokens,
-            request.temperature,
-        ],
+            RESPONSE_CACHE_TTL_SECONDS,
+            stale_task_id=existing,
+            attach=attach,
+        )
+    return key, existing
+
+
+async def is_stale_claim(key: str, task_id: str) -> bool:
+    """Whether the task claimed for response ``key`` will never answer it.
+
+    Failed and revoked tasks are retried rather than served for the rest of the
+    TTL. So is a task without a result that was cancelled (it will end
+    revoked), is no longer admitted (never queued) or was admitted too long ago
+    (its worker died).
+    """
+    meta = await task_meta(task_id)
+    if meta is not None:
+        return meta["status"] in states.PROPAGATE_STATES
+    if await async_is_task_cancelled(task_id):
+        return True
+    if await async_is_task_admitted(task_id, ADMISSION_STALE_SECONDS):
+        return False
+    age = RESPONSE_CACHE_TTL_SECONDS - await async_redis_client.ttl(key)
+    return age > CLAIM_ADMIT_GRACE_SECONDS
+
+
+async def admit(session_id: str, task_id: str):
+    """Admit a new inference task, or raise 429 when the queue or the session is
+    full, with a ``Retry-After`` estimated from measured throughput."""
+    status, depth, rate = await async_admit_task(
+        task_id,
+        session_id,
+        MAX_QUEUE_DEPTH,
+        MAX_SESSION_INFLIGHT,
+        ADMISSION_STALE_SECONDS,
+    )
+    if status == 1:
+        return
+    if status == 0:
+        detail = "Too many requests are queued. Try again later."
+        # The queue has to drain to just below the limit.
+        waiting = depth - MAX_QUEUE_DEPTH + 1
+    else:
+        detail = "This session has too many requests in progress."
+        # One of the session's tasks has to finish, somewhere in the queue.
+        waiting = depth
+    if rate > 0:
+        retry_after = math.ceil(max(waiting, 1) / rate)
+    else:
+        retry_after = DEFAULT_RETRY_AFTER_SECONDS
+    retry_after = min(max(retry_after, 1), MAX_RETRY_AFTER_SECONDS)
+    raise HTTPException(
+        status_code=429, detail=detail, headers={"Retry-After": str(retry_after)}
+    )
+
+
+async def send_inference(
+    request: GenerateRequest,
+    session_id: str,
+    task_id: str,
+    claimed_key: Optional[str] = None,
+    stream: bool = False,
+):
+    """Admit and queue the inference task. ``claimed_key`` is the response key
+    this task was claimed under (see ``claim_response``), released if it is not
+    queued.
+
+    Short requests go to ``PRIORITY_QUEUE`` so they are not stuck behind long
+    generations.
+    """
+    queue = None
+    if request.max_new_tokens <= PRIORITY_MAX_NEW_TOKENS:
+        queue = PRIORITY_QUEUE
+    admitted = False
+    try:
+        await admit(session_id, task_id)
+        admitted = True
+        await send_task(
+            "tasks.inference",
+            [
+                session_id,
+                request.model_name,
+                request.prompt,
+                request.max_new_tokens,
+                request.temperature,
+                stream,
+            ],
+            task_id,
+            queue,
+        )
+    except Exception:
+        if claimed_key is not None:
+            await async_redis_client.delete(claimed_key)
+        if admitted:
+            await async_release_task(task_id, session_id)
+        raise
+
+
+@app.post("/generate")
+async def generate(request: GenerateRequest, session_id: str = Depends(get_session_id)):
+    task_id = str(uuid.uuid4())
+    key, existing = await claim_response(request, session_id, task_id)
+    if existing is not None:
+        return {"task_id": existing}
+    await send_inference(request, session_id, task_id, key)
+    return {"task_id": task_id}
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_task_ended(task_id: str) -> Optional[Tuple[str, dict]]:
+    """The final event for a streamed task that went quiet, or None while it is
+    still queued or running."""
+    meta = await task_meta(task_id)
+    if meta is not None and meta["status"] == states.SUCCESS:
+        return "done", meta["result"]
+    if meta is not None and meta["status"] in states.READY_STATES:
+        return "error", {"detail": f"Generation ended: {meta['status']}."}
+    if meta is None and not await async_is_task_admitted(
+        task_id, ADMISSION_STALE_SECONDS
+    ):
+        return "error", {"detail": "Generation was lost."}
+    return None
+
+
+@app.post("/generate_stream")
+async def generate_stream(
+    request: GenerateRequest,
+    response: Response,
+    session_id: str = Depends(get_session_id),
+):
+    """Run inference and relay tokens as Server-Sent Events.
+
+    Emits one ``task`` event with the task id, ``token`` events as text is
+    generated, and finally ``done`` (with the full response) or ``error``. A
+    stream quiet for ``STREAM_IDLE_SECONDS`` gets a keepalive comment, or an
+    ``error`` if its task has ended without a word or was lost.
+    """
+    task_id = str(uuid.uuid4())
+    # Only a finished task is replayed, so a running one is not attached to.
+    claimed, existing = await claim_response(
+        request, session_id, task_id, attach=False
+    )
+    cached = None
+    if existing is not None:
+        claimed = None
+        meta = await task_meta(existing)
+        # A finished response is replayed; a running task's earlier tokens
+        # cannot be, so this request then runs on its own.
+        if meta is not None and meta["status"] == states.SUCCESS:
+            task_id, cached = existing, meta["result"]
+
+    pubsub = None
+    if cached is None:
+        # Subscribe before the task is queued so no tokens can be missed.
+        pubsub = async_redis_client.pubsub()
+        await pubsub.subscribe(stream_channel(task_id))
+        try:
+            await send_inference(request, session_id, task_id, claimed, stream=True)
+        except Exception:
+            await pubsub.unsubscribe()
+            await pubsub.aclose()
+            raise
+
+    async def events():
+        yield sse_event("task", {"task_id": task_id})
+        if cached is not None:
+            yield sse_event("done", cached)
+            return
+        finished = False
+        try:
+            while not finished:
+                message = await pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=STREAM_IDLE_SECONDS
+                )
+                if message is None:
+                    # The worker only reports exceptions; a dead worker or a
+                    # task that never ran says nothing.
+                    ended = await stream_task_ended(task_id)
+                    if ended is None:
+                        yield ": keepalive\n\n"
+                        continue
+                    event, data = ended
+                else:
+                    payload = json.loads(message["data"])
+                    event, data = payload["event"], payload["data"]
+                yield sse_event(event, data)
+                finished = event in ("done", "error")
+        finally:
+            # A client disconnect cancels this generator, so the cleanup has to
+            # be shielded to run at all.
+            with anyio.CancelScope(shield=True):
+                if not finished:
+                    await async_cancel_task(task_id, session_id)
+                await pubsub.unsubscribe()
+                await pubsub.aclose()
+
+    stream = StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
-    return {"task_id": task.id}
+    # A returned Response bypasses the dependency's response, so carry over the
+    # session cookie explicitly.
+    stream.raw_headers.extend(
+        (key, value) for key, value in response.raw_headers if key == b"set-cookie"
+    )
+    return stream
 
 
 @app.post("/merge")
-def merge(request: MergeRequest, session_id: str = Depends(get_session_id)):
-    task = celery_app.send_task(
-        "tasks.merge_models",
-        args=[
-            session_id,
-            request.model1_name,
-            request.model2_name,
+async def merge(request: MergeRequest, session_id: str = Depends(get_session_id)):
+    """Merge two models' recipes and save the child under a fresh name.
+
+    Only recipe arithmetic and Redis, so it runs here rather than on a worker.
+    """
+    if len(request.layer_recipe) > MAX_LAYERS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Layer recipe too long. Max {MAX_LAYERS} layers supported.",
+        )
+
+    model1_recipe, model2_recipe = await asyncio.gather(
+        async_get_model_recipe_default(session_id, request.model1_name),
+        async_get_model_recipe_default(session_id, request.model2_name),
+    )
+    if model1_recipe is None or model2_recipe is None:
+        raise HTTPException(status_code=404, detail="One of the models does not exist.")
+
+    try:
+        merged_recipe = merge_model_recipe(
+            model1_recipe,
+            model2_recipe,
             request.layer_recipe,
             request.embedding_lambdas,
             request.linear_lambdas,
-            request.merged_name,
-        ],
-    )
+        )
+    except (IndexError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid layer recipe: {e}")
 
-    return {"task_id": task.id}
+    full_merged_name = await async_allocate_model_name(
+        session_id, request.merged_name, merged_recipe
+    )
+    if full_merged_name is None:
+        raise HTTPException(
+            status_code=409, detail="Could not find a unique model name."
+        )
+    return {"response": full_merged_name}
 
 
 @app.post("/list_models")
-def list_models(session_id: str = Depends(get_session_id)):
-    task = celery_app.send_task("tasks.get_all_models", args=[session_id])
-    return {"task_id": task.id}
+async def list_models(session_id: str = Depends(get_session_id)):
+    session_models = await async_get_session_models(session_id)
+    return {"response": list(set(BASE_MODELS_NAMES + session_models))}
+
+
+@app.post("/clear_session")
+async def clear_session(session_id: str = Depends(get_session_id)):
+    await async_delete_session(session_id)
+    return {"response": ""}
+
+
+@app.post("/export")
+async def export(request: ExportRequest, session_id: str = Depends(get_session_id)):
+    """Export a model's merged weights for ``from_pretrained``.
+
+    The task's result holds the recipe hash; the files are then served from
+    ``/exports/{recipe_hash}/``.
+    """
+    task_id = str(uuid.uuid4())
+    await send_task("tasks.export", [session_id, request.model_name], task_id)
+    return {"task_id": task_id}
+
+
+@app.get("/exports/{recipe_hash}/{filename}")
+async def get_export(recipe_hash: str, filename: str):
+    if (
+        filename not in EXPORT_FILES
+        or len(recipe_hash) != 64
+        or not all(c in "0123456789abcdef" for c in recipe_hash)
+    ):
+        raise HTTPException(status_code=404, detail="Export not found.")
+    path = os.path.join(EXPORT_DIR, recipe_hash, filename)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Export not found.")
+    return FileResponse(path, filename=filename)
+
+
+@app.get("/ready")
+async def ready(response: Response):
+    """Readiness probe: 200 once at least one warm worker is consuming tasks."""
+    workers = await async_get_ready_workers()
+    if not workers:
+        response.status_code = 503
+    return {"ready": bool(workers), "workers": len(workers)}
+
+
+async def wait_for_task(task_id: str, timeout: float):
+    """Wait until the result backend publishes a finished state for the task,
+    or the timeout runs out.
+
+    The Redis result backend publishes every stored state on the task's meta
+    key, so this waits on pub/sub rather than polling.
+    """
+    channel = celery_app.backend.get_key_for_task(task_id).decode()
+    pubsub = async_redis_client.pubsub()
+    await pubsub.subscribe(channel)
+    try:
+        # The result may have been stored before we subscribed.
+        meta = await async_redis_client.get(channel)
+        if meta and json.loads(meta)["status"] in states.READY_STATES:
+            return
+        async with asyncio.timeout(timeout):
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                if json.loads(message["data"])["status"] in states.READY_STATES:
+                    return
+    except TimeoutError:
+        pass
+    finally:
+        await pubsub.unsubscribe()
+        await pubsub.aclose()
+
+
+async def wait_for_disconnect(request: Request):
+    while not await request.is_disconnected():
+        await asyncio.sleep(DISCONNECT_POLL_SECONDS)
+
+
+async def task_status(task_id: str) -> dict:
+    meta = await task_meta(task_id)
+    if meta is None or meta["status"] not in states.READY_STATES:
+        return {"status": meta["status"] if meta else states.PENDING}
+    if meta["status"] == states.FAILURE:
+        exc = celery_app.backend.exception_to_python(meta["result"])
+        raise HTTPException(status_code=500, detail=str(exc))
+    if meta["status"] == states.REVOKED:
+        return {"status": meta["status"]}
+    return {"status": meta["status"], "result": meta["result"]}
 
 
 @app.get("/tasks/{task_id}")
-def get_task_status(task_id: str):
-    task_result = celery_app.AsyncResult(task_id)
-
-    if task_result.ready():
-        if task_result.status == "FAILURE":
-            raise HTTPException(status_code=500, detail=str(task_result.result))
-        else:
-            return {"status": task_result.status, "result": task_result.result}
-    else:
-        return {"status": task_result.status}
+async def get_task_status(
+    task_id: str,
+    request: Request,
+    wait: float = Query(0, ge=0, le=60),
+    session_id: str = Depends(get_session_id),
+):
+    """Task status. With ``wait`` (seconds) the request is held open until the
+    task finishes or the wait runs out, instead of returning immediately.
+
+    A client that disconnects during the wait has abandoned the task, so it is
+    cancelled if it is this session's and no other request still waits for it.
+    """
+    if wait > 0:
+        waiter = asyncio.ensure_future(wait_for_task(task_id, wait))
+        watcher = asyncio.ensure_future(wait_for_disconnect(request))
+        done, pending = await asyncio.wait(
+            {waiter, watcher}, return_when=asyncio.FIRST_COMPLETED
+        )
+        for future in pending:
+            future.cancel()
+        if waiter not in done:
+            await async_cancel_task(task_id, session_id)
+    return await task_status(task_id)
+
+
+@app.delete("/tasks/{task_id}")
+async def cancel_task(task_id: str, session_id: str = Depends(get_session_id)):
+    """Cancel one of this session's tasks. A queued task is skipped when a worker
+    reaches it, and a running generation stops within ``CANCEL_CHECK_TOKENS``
+    tokens (a worker setting). A task shared with other identical requests keeps
+    running for them."""
+    if not await async_cancel_task(task_id, session_id):
+        raise HTTPException(
+            status_code=404, detail="This session has no such task in progress."
+        )
+    return {"response": ""}
@@ -0,0 +1,79 @@
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, List, Tuple
+
+
+class BatchScheduler:
+    """Collects concurrent requests that share a key and runs them as one batch.
+
+    The first request for a key opens a window of ``window_seconds``; every
+    request for the same key that arrives before the window closes (up to
+    ``max_batch_size``) is handed to ``run_batch`` together. Batches run one at
+    a time on a single background thread, since each one already saturates the
+    CPU.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[Hashable, List[Any]], List[Any]],
+        window_seconds: float,
+        max_batch_size: int,
+    ):
+        self.run_batch = run_batch
+        self.window_seconds = window_seconds
+        self.max_batch_size = max_batch_size
+        self._pending: Dict[Hashable, List[Tuple[Any, Future]]] = {}
+        self._opened: Dict[Hashable, float] = {}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def submit(self, key: Hashable, item: Any) -> Future:
+        future = Future()
+        with self._cond:
+            if self._thread is None:
+                # Started lazily so that it lives in the process that uses it,
+                # not in a prefork parent.
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            if key not in self._pending:
+                self._pending[key] = []
+                self._opened[key] = time.monotonic()
+            self._pending[key].append((item, future))
+            self._cond.notify()
+        return future
+
+    def _next_batch(self) -> Tuple[Hashable, List[Tuple[Any, Future]]]:
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+
+            key = min(self._pending, key=self._opened.get)
+            deadline = self._opened[key] + self.window_seconds
+            while len(self._pending[key]) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch = self._pending[key][: self.max_batch_size]
+            rest = self._pending[key][self.max_batch_size :]
+            if rest:
+                self._pending[key] = rest
+                self._opened[key] = time.monotonic()
+            else:
+                del self._pending[key]
+                del self._opened[key]
+            return key, batch
+
+    def _run(self):
+        while True:
+            key, batch = self._next_batch()
+            try:
+                results = self.run_batch(key, [item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
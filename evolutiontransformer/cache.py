@@ -0,0 +1,385 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence, Set, Tuple
+
+import torch
+import torch.nn as nn
+from torch.ao.nn.quantized import Linear as QuantizedLinear
+
+
+def _storages(model: nn.Module):
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        if tensor.device.type != "meta":
+            yield tensor.untyped_storage()
+
+
+def storage_ptrs(models: Dict[str, nn.Module]) -> Set[int]:
+    """Data pointers of every storage owned by the given models."""
+    return {
+        storage.data_ptr() for model in models.values() for storage in _storages(model)
+    }
+
+
+def model_nbytes(model: nn.Module, exclude: Set[int] = frozenset()) -> int:
+    """Bytes held by a module's parameters and buffers, counting shared storage once.
+
+    Storages whose data pointer is in ``exclude`` (e.g. aliased base model
+    weights) are not counted. Packed weights of quantized linear layers, which
+    are neither parameters nor buffers, are counted too.
+    """
+    return models_nbytes([model], exclude)
+
+
+def models_nbytes(models: Sequence[nn.Module], exclude: Set[int] = frozenset()) -> int:
+    """Like ``model_nbytes``, over several modules that may share storage."""
+    seen = set(exclude)
+    total = 0
+    for model in models:
+        for storage in _storages(model):
+            if storage.data_ptr() in seen:
+                continue
+            seen.add(storage.data_ptr())
+            total += storage.nbytes()
+        for module in model.modules():
+            if isinstance(module, QuantizedLinear):
+                for tensor in module._weight_bias():
+                    if tensor is not None:
+                        total += tensor.numel() * tensor.element_size()
+    return total
+
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by a byte budget instead of an entry count."""
+
+    def __init__(self, max_bytes: int, sizeof: Callable[[Any], int]):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if size > self.max_bytes:
+                return
+            while self._bytes + size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            self._entries[key] = value
+            self._sizes[key] = size
+            self._bytes += size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+    def _remove(self, key: Hashable) -> None:
+        del self._entries[key]
+        self._bytes -= self._sizes.pop(key)
+
+    def items(self) -> List[Tuple[Hashable, Any]]:
+        """Snapshot of the entries, least recently used first, without touching
+        their recency."""
+        with self._lock:
+            return list(self._entries.items())
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class ModelCache(LRUCache):
+    """Materialized child models keyed by recipe hash.
+
+    The budget covers every storage the cached children hold, including blocks
+    shared through ``BlockCache``, each counted once however many children use
+    it. Tensors aliased from ``shared_storage()`` are already paid for by the
+    base models and are not counted. Evicting a child only frees the storage no
+    other cached child holds, so ``put`` evicts until the total fits.
+    """
+
+    def __init__(
+        self, max_bytes: int, shared_storage: Callable[[], Set[int]] = frozenset
+    ):
+        super().__init__(
+            max_bytes, lambda model: model_nbytes(model, exclude=shared_storage())
+        )
+        self.shared_storage = shared_storage
+
+    def put(self, key: Hashable, value: Any) -> None:
+        exclude = self.shared_storage()
+        with self._lock:
+            self._entries.pop(key, None)
+            if models_nbytes([value], exclude) <= self.max_bytes:
+                self._entries[key] = value
+            self._bytes = models_nbytes(list(self._entries.values()), exclude)
+            while self._bytes > self.max_bytes:
+                del self._entries[next(iter(self._entries))]
+                self.evictions += 1
+                self._bytes = models_nbytes(list(self._entries.values()), exclude)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+class BlockCache:
+    """Merged transformer blocks shared between children, keyed by layer recipe.
+
+    A block stays cached while any live child references it (``acquire`` adds a
+    reference, ``release`` drops it). Blocks no child references are kept for
+    future recipes up to ``max_bytes`` and evicted least recently used first.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._blocks: Dict[Hashable, torch.Tensor] = {}
+        self._refs: Dict[Hashable, int] = {}
+        self._idle = OrderedDict()
+        self._idle_bytes = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, key: Hashable, build: Callable[[], torch.Tensor]) -> torch.Tensor:
+        """The block for ``key``, built with ``build`` on a miss, with a reference
+        taken on it."""
+        with self._lock:
+            if key in self._blocks:
+                self.hits += 1
+                self._ref(key)
+                return self._blocks[key]
+            self.misses += 1
+        block = build()
+        with self._lock:
+            # Another thread may have built the same block meanwhile.
+            if key not in self._blocks:
+                self._blocks[key] = block
+                self._refs[key] = 0
+            self._ref(key)
+            return self._blocks[key]
+
+    def release(self, keys: List[Hashable]) -> None:
+        with self._lock:
+            for key in keys:
+                self._refs[key] -= 1
+                if self._refs[key] == 0:
+                    # A block loaded from disk is a row of a larger mapping;
+                    # only the row counts.
+                    nbytes = self._blocks[key].nbytes
+                    self._idle[key] = nbytes
+                    self._idle_bytes += nbytes
+            while self._idle_bytes > self.max_bytes:
+                key, nbytes = self._idle.popitem(last=False)
+                self._idle_bytes -= nbytes
+                del self._blocks[key]
+                del self._refs[key]
+                self.evictions += 1
+
+    def _ref(self, key: Hashable) -> None:
+        if key in self._idle:
+            self._idle_bytes -= self._idle.pop(key)
+        self._refs[key] += 1
+
+    def __len__(self) -> int:
+        return len(self._blocks)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "blocks": len(self._blocks),
+                "bytes": sum(block.nbytes for block in self._blocks.values()),
+                "idle_bytes": self._idle_bytes,
+                "max_idle_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class DiskCache:
+    """Files named by key in one directory, bounded by a byte budget.
+
+    Meant to be shared by every worker process on a machine, so all state lives
+    in the filesystem: a file's mtime is its last use, and once the directory
+    holds more than ``max_bytes`` the least recently used files are deleted.
+    Writers must create files atomically (write elsewhere, then rename), so a
+    file that exists is complete. A budget of 0 disables the cache.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, suffix: str = ".safetensors"):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}{self.suffix}")
+
+    def get(self, key: str) -> Optional[str]:
+        """Path of the file for ``key``, marked as just used, or None."""
+        if self.max_bytes <= 0:
+            return None
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def put(self, key: str, write: Callable[[str], None]) -> None:
+        """Create the file for ``key`` with ``write(path)``, then evict."""
+        if self.max_bytes <= 0:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        write(self.path(key))
+        self.evict()
+
+    def _files(self) -> List[Tuple[float, int, str]]:
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith(self.suffix):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        return sorted(files)
+
+    def evict(self) -> None:
+        files = self._files()
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            # Processes that have the file mapped keep their pages until they
+            # unmap it; only the name goes away.
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self) -> dict:
+        files = self._files() if os.path.isdir(self.directory) else []
+        return {
+            "files": len(files),
+            "bytes": sum(size for _, size, _ in files),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def kv_cache_nbytes(past_key_values) -> int:
+    """Bytes held by the key and value tensors of a ``DynamicCache``."""
+    return sum(
+        tensor.nbytes
+        for layer in past_key_values.layers
+        for tensor in (layer.keys, layer.values)
+        if tensor is not None
+    )
+
+
+def compact_kv_cache(past_key_values, length: int):
+    """Crop a ``DynamicCache`` to ``length`` tokens, in place, without views.
+
+    Cropping slices the tensors, which would keep the full generation's storage
+    alive; cloning leaves only what the cache reports.
+    """
+    past_key_values.crop(length)
+    for layer in past_key_values.layers:
+        if layer.keys is not None:
+            layer.keys = layer.keys.clone()
+            layer.values = layer.values.clone()
+    return past_key_values
+
+
+def _common_prefix_len(a: Sequence[int], b: Sequence[int]) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class PrefixCache(LRUCache):
+    """Prefill KV caches keyed by ``(recipe hash, prompt token ids)``.
+
+    A lookup returns the entry sharing the longest token prefix with a new
+    prompt, so prompts that only share a few-shot preamble still reuse it.
+    Shorter matches than ``min_tokens`` are not worth the copy and count as
+    misses.
+    """
+
+    def __init__(self, max_bytes: int, min_tokens: int = 1):
+        super().__init__(max_bytes, kv_cache_nbytes)
+        self.min_tokens = max(1, min_tokens)
+
+    def longest_prefix(
+        self, recipe_key: str, token_ids: Sequence[int]
+    ) -> Tuple[int, Optional[Any]]:
+        """Return ``(shared length, cache)`` for the best entry, or ``(0, None)``.
+
+        The returned cache is shared and covers its own prompt; callers copy
+        and crop it before use.
+        """
+        token_ids = tuple(token_ids)
+        with self._lock:
+            best_len, best_key = 0, None
+            for key in self._entries:
+                if key[0] != recipe_key:
+                    continue
+                n = _common_prefix_len(key[1], token_ids)
+                if n > best_len:
+                    best_len, best_key = n, key
+            if best_len < self.min_tokens:
+                self.misses += 1
+                return 0, None
+            self._entries.move_to_end(best_key)
+            self.hits += 1
+            return best_len, self._entries[best_key]
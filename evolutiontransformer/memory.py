@@ -0,0 +1,60 @@
+"""Per-process memory accounting.
+
+Run ``python -m evolutiontransformer.memory`` on the worker host to see how much
+of each Celery process is unique to it and how much is shared with the other
+processes (e.g. the memory-mapped base weights).
+"""
+
+import os
+import sys
+from typing import Dict, List, Union
+
+
+def process_memory(pid: Union[int, str] = "self") -> Dict[str, float]:
+    """RSS of a process split into shared and unique pages, in MiB."""
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                fields[parts[0][:-1]] = int(parts[1]) / 1024
+
+    return {
+        "rss": fields.get("Rss", 0.0),
+        "pss": fields.get("Pss", 0.0),
+        "shared": fields.get("Shared_Clean", 0.0) + fields.get("Shared_Dirty", 0.0),
+        "unique": fields.get("Private_Clean", 0.0) + fields.get("Private_Dirty", 0.0),
+    }
+
+
+def celery_pids() -> List[int]:
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/cmdline", "rb") as f:
+                cmdline = f.read().replace(b"\0", b" ")
+        except OSError:
+            continue
+        if b"celery" in cmdline and b"worker" in cmdline:
+            pids.append(int(entry))
+    return sorted(pids)
+
+
+def main(argv: List[str]) -> None:
+    pids = [int(pid) for pid in argv] or celery_pids()
+    print(f"{'pid':>8} {'rss':>10} {'pss':>10} {'shared':>10} {'unique':>10}  (MiB)")
+    for pid in pids:
+        try:
+            mem = process_memory(pid)
+        except OSError:
+            continue
+        print(
+            f"{pid:>8} {mem['rss']:>10.1f} {mem['pss']:>10.1f} "
+            f"{mem['shared']:>10.1f} {mem['unique']:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
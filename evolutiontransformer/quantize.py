@@ -0,0 +1,64 @@
+import copy
+
+import torch
+import torch.nn as nn
+from transformers.pytorch_utils import Conv1D
+
+
+def conv1d_to_linear(conv: Conv1D) -> nn.Linear:
+    """An ``nn.Linear`` computing the same thing as a GPT-2 ``Conv1D``.
+
+    ``Conv1D`` stores its weight as (in, out); dynamic quantization only
+    handles ``nn.Linear``, which stores (out, in).
+    """
+    in_features, out_features = conv.weight.shape
+    linear = nn.Linear(in_features, out_features, device="meta")
+    linear.weight = nn.Parameter(conv.weight.detach().t(), requires_grad=False)
+    linear.bias = nn.Parameter(conv.bias.detach(), requires_grad=False)
+    return linear
+
+
+def quantize_model(model: nn.Module) -> nn.Module:
+    """An int8 dynamically quantized copy of a merged child, for CPU serving.
+
+    The transformer blocks' projections are quantized; embeddings, layer norms
+    and the (tied) lm_head stay fp32. ``model`` is left untouched, and the copy
+    shares every tensor it does not quantize with it.
+    """
+    # Pre-seeding the memo makes deepcopy copy the module tree but not the
+    # tensors, which may be aliased from the base models.
+    memo = {id(tensor): tensor for tensor in model.parameters()}
+    memo.update({id(tensor): tensor for tensor in model.buffers()})
+    quantized = copy.deepcopy(model, memo)
+
+    for block in quantized.transformer.h:
+        for name, module in list(block.named_modules()):
+            if isinstance(module, Conv1D):
+                parent_name, _, child_name = name.rpartition(".")
+                parent = block.get_submodule(parent_name) if parent_name else block
+                setattr(parent, child_name, conv1d_to_linear(module))
+
+    torch.ao.quantization.quantize_dynamic(
+        quantized.transformer.h, {nn.Linear}, dtype=torch.qint8, inplace=True
+    )
+    return quantized.eval()
+
+
+def upcast_model(model: nn.Module, dtype: torch.dtype = torch.float32) -> nn.Module:
+    """A copy of a merged child with its floating-point tensors in ``dtype``.
+
+    For CPUs without native bf16, where bf16 matmuls are emulated and much
+    slower than fp32. ``model`` is left untouched; tensors it shares between
+    modules (e.g. tied embeddings) stay shared in the copy.
+    """
+    # Seeding the memo with converted tensors makes deepcopy use them in place
+    # of the originals.
+    memo = {}
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        if id(tensor) in memo or not tensor.is_floating_point():
+            continue
+        converted = tensor.detach().to(dtype)
+        if isinstance(tensor, nn.Parameter):
+            converted = nn.Parameter(converted, requires_grad=False)
+        memo[id(tensor)] = converted
+    return copy.deepcopy(model, memo).eval()
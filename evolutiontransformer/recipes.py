@@ -0,0 +1,139 @@
+import hashlib
+import json
+from typing import Any, Dict, List, Set, Tuple
+
+ALPHA_DECIMALS = 6
+
+
+def _round(alpha: float) -> float:
+    # + 0.0 turns -0.0 into 0.0 so both serialize the same way.
+    return round(float(alpha), ALPHA_DECIMALS) + 0.0
+
+
+def canonicalize_layer(terms) -> list:
+    """Canonical form of one layer's ``(layer, model, alpha)`` terms.
+
+    Duplicate ``(layer, model)`` terms are summed, alphas are rounded to
+    ``ALPHA_DECIMALS``, zero-weight terms are dropped and the rest are sorted by
+    model then layer.
+    """
+    weights = {}
+    for layer, model, alpha in terms:
+        key = (int(layer), model)
+        weights[key] = weights.get(key, 0.0) + float(alpha)
+
+    canonical = []
+    for (layer, model), alpha in sorted(weights.items(), key=lambda kv: kv[0][::-1]):
+        alpha = _round(alpha)
+        if alpha != 0.0:
+            canonical.append([layer, model, alpha])
+    return canonical
+
+
+def canonicalize_recipe(recipe: dict) -> dict:
+    """Canonical form of a recipe, so recipes that merge the same way compare equal.
+
+    Layers keep their order (it is the child's layer order); see
+    ``canonicalize_layer`` for what happens within a layer.
+    """
+    return {
+        "layer_recipe": [canonicalize_layer(terms) for terms in recipe["layer_recipe"]],
+        "embedding_lambdas": [_round(lam) for lam in recipe["embedding_lambdas"]],
+        "linear_lambdas": [_round(lam) for lam in recipe["linear_lambdas"]],
+    }
+
+
+def recipe_hash(recipe: dict) -> str:
+    """Content hash of a recipe's canonical form."""
+    payload = json.dumps(
+        canonicalize_recipe(recipe), sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def recipe_parts(recipe: dict) -> Dict[str, Any]:
+    """The canonical recipe of each separately merged part of a child.
+
+    Keys are ``"wte"``, ``"wpe"``, ``"lm_head"``, ``"ln_f"`` and ``"h.<i>"``
+    for every layer.
+    """
+    recipe = canonicalize_recipe(recipe)
+    parts = {
+        "wte": recipe["embedding_lambdas"][0],
+        "wpe": recipe["embedding_lambdas"][1],
+        "lm_head": recipe["linear_lambdas"][0],
+        "ln_f": recipe["linear_lambdas"][1],
+    }
+    for i, terms in enumerate(recipe["layer_recipe"]):
+        parts[f"h.{i}"] = terms
+    return parts
+
+
+def changed_parts(old: dict, new: dict) -> Set[str]:
+    """Parts of ``new`` that ``old`` merges differently (see ``recipe_parts``)."""
+    old_parts = recipe_parts(old)
+    return {
+        part
+        for part, value in recipe_parts(new).items()
+        if old_parts.get(part) != value
+    }
+
+
+BASE_MODELS_NAMES = ["svamp", "tinystories"]
+BASE_MODEL_LAYERS = 24
+MAX_LAYERS = 48
+
+
+def base_model_recipe(model_name: str) -> dict:
+    """Recipe of an unmerged parent: every layer taken whole from itself."""
+    return {
+        "layer_recipe": [[(i, model_name, 1.0)] for i in range(BASE_MODEL_LAYERS)],
+        "embedding_lambdas": [1.0, 1.0],
+        "linear_lambdas": [1.0, 1.0],
+    }
+
+
+def merge_model_recipe(
+    model1_recipe: dict,
+    model2_recipe: dict,
+    layer_recipe: List[List[Tuple[int, int, float]]],
+    embedding_lambdas: List[float] = [0.5, 0.5],
+    linear_lambdas: List[float] = [0.5, 0.5],
+) -> dict:
+    models = [model1_recipe, model2_recipe]
+    result_layer_recipe = []
+    for makeup in layer_recipe:
+        layer_result = {}
+        for comb in makeup:
+            idx, model_i, alpha = comb
+
+            for orig_i, orig_model, orig_a in models[model_i]["layer_recipe"][idx]:
+                if (orig_i, orig_model) in layer_result:
+                    layer_result[(orig_i, orig_model)] += alpha * orig_a
+                else:
+                    layer_result[(orig_i, orig_model)] = alpha * orig_a
+
+        final_layer_result = []
+        for k in layer_result:
+            final_layer_result.append((k[0], k[1], layer_result[k]))
+
+        result_layer_recipe.append(final_layer_result)
+
+    result_embedding_lambdas = [
+        embedding_lambdas[0] * model1_recipe["embedding_lambdas"][0]
+        + (1 - embedding_lambdas[0]) * model2_recipe["embedding_lambdas"][0],
+        embedding_lambdas[1] * model1_recipe["embedding_lambdas"][1]
+        + (1 - embedding_lambdas[1]) * model2_recipe["embedding_lambdas"][1],
+    ]
+    result_linear_lambdas = [
+        linear_lambdas[0] * model1_recipe["linear_lambdas"][0]
+        + (1 - linear_lambdas[0]) * model2_recipe["linear_lambdas"][0],
+        linear_lambdas[1] * model1_recipe["linear_lambdas"][1]
+        + (1 - linear_lambdas[1]) * model2_recipe["linear_lambdas"][1],
+    ]
+
+    return {
+        "layer_recipe": result_layer_recipe,
+        "embedding_lambdas": result_embedding_lambdas,
+        "linear_lambdas": result_linear_lambdas,
+    }
@@ -1,62 +1,424 @@
+import hashlib
 import os
+import time
 from redis import Redis
+from redis import asyncio as aioredis
 import json
+from evolutiontransformer.recipes import (
+    BASE_MODELS_NAMES,
+    base_model_recipe,
+    canonicalize_recipe,
+    recipe_hash,
+)
 
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 redis_client = Redis.from_url(REDIS_URL, decode_responses=True)
+async_redis_client = aioredis.Redis.from_url(REDIS_URL, decode_responses=True)
 
 
-def get_session_models(session_id: str):
-    try:
-        session_key = f"session:{session_id}:models"
-        models = redis_client.json().get(session_key, "$")
-        if models and len(models) > 0:
-            return models[0]
-        return []
-    except Exception as e:
-        print(f"Error getting session models: {e}")
-        return []
+SESSION_TTL_SECONDS = 3600
 
+# Sessions are a hash of model name -> recipe hash; recipes live once under
+# recipe:<hash>. Each operation below is a single round trip. The API runs them
+# on the async client; workers only read recipes.
 
-def add_model_to_session(session_id: str, model_name: str, ttl_seconds: int = 3600):
-    session_key = f"session:{session_id}:models"
+# KEYS: session hash. ARGV: ttl. Returns the model names and refreshes the TTL
+# of the session and every recipe it references.
+SESSION_MODELS_LUA = """
+local entries = redis.call("HGETALL", KEYS[1])
+local names = {}
+for i = 1, #entries, 2 do
+    names[#names + 1] = entries[i]
+    redis.call("EXPIRE", "recipe:" .. entries[i + 1], ARGV[1])
+end
+if #names > 0 then
+    redis.call("EXPIRE", KEYS[1], ARGV[1])
+end
+return names
+"""
 
-    existing_models = get_session_models(session_id)
+# KEYS: session hash. ARGV: model name, ttl. Returns the recipe JSON (or nil)
+# and refreshes the TTL of the session and every recipe it references, so a
+# session kept alive by generating with one model does not lose the others.
+GET_MODEL_RECIPE_LUA = """
+local recipe_id = redis.call("HGET", KEYS[1], ARGV[1])
+if not recipe_id then
+    return false
+end
+redis.call("EXPIRE", KEYS[1], ARGV[2])
+for _, id in ipairs(redis.call("HVALS", KEYS[1])) do
+    redis.call("EXPIRE", "recipe:" .. id, ARGV[2])
+end
+return redis.call("GET", "recipe:" .. recipe_id)
+"""
 
-    if model_name not in existing_models:
-        existing_models.append(model_name)
+# KEYS: session hash, recipe key. ARGV: base name, attempts, recipe hash,
+# recipe JSON, ttl. Claims the first free "<base>_<i>" and stores the recipe;
+# returns the claimed name, or nil if every candidate is taken.
+ALLOCATE_MODEL_NAME_LUA = """
+for i = 0, tonumber(ARGV[2]) - 1 do
+    local name = ARGV[1] .. "_" .. i
+    if redis.call("HSETNX", KEYS[1], name, ARGV[3]) == 1 then
+        redis.call("SET", KEYS[2], ARGV[4], "EX", ARGV[5])
+        redis.call("EXPIRE", KEYS[1], ARGV[5])
+        return name
+    end
+end
+return false
+"""
 
-    redis_client.json().set(session_key, "$", existing_models)
-    redis_client.expire(session_key, ttl_seconds)
+# Requests sharing a task through the response cache are counted per session
+# in watchers:<task id>, so one of them abandoning it does not cancel it for
+# the others.
+# KEYS: response key. ARGV: task id, ttl, stale task id, session id, attach
+# ("1" or ""). Returns the id of the task already answering the request, unless
+# it is the stale one; otherwise stores ARGV[1] as that task and returns nil.
+# The session is counted as a watcher of the task it claims, and of the one it
+# gets back if attaching.
+CLAIM_RESPONSE_LUA = """
+local task_id = redis.call("GET", KEYS[1])
+if task_id and task_id ~= ARGV[3] then
+    if ARGV[5] == "1" then
+        redis.call("HINCRBY", "watchers:" .. task_id, ARGV[4], 1)
+        redis.call("EXPIRE", "watchers:" .. task_id, ARGV[2])
+    end
+    return task_id
+end
+redis.call("SET", KEYS[1], ARGV[1], "EX", ARGV[2])
+redis.call("HINCRBY", "watchers:" .. ARGV[1], ARGV[4], 1)
+redis.call("EXPIRE", "watchers:" .. ARGV[1], ARGV[2])
+return false
+"""
 
+# Admission control tracks admitted inference tasks (queued or running) in
+# sorted sets scored by admission time, globally and per session, so an entry a
+# dead worker never released can be dropped once it is stale. Finished tasks
+# are scored by finish time, to measure throughput.
+ADMISSION_INFLIGHT_KEY = "admission:inflight"
+ADMISSION_COMPLETED_KEY = "admission:completed"
+ADMISSION_WINDOW_SECONDS = 300
+# Long enough for a cancelled task to still be flagged when a worker reaches it.
+CANCEL_TTL_SECONDS = 3600
 
-def save_model_recipe(
-    session_id: str, model_name: str, recipe: dict, ttl_seconds: int = 3600
-):
-    recipe_key = f"model:{session_id}:{model_name}"
-    redis_client.json().set(recipe_key, "$", recipe)
-    redis_client.expire(recipe_key, ttl_seconds)
+# KEYS: inflight, session inflight, completed. ARGV: task id, now, stale
+# cutoff, max queue depth, max session in flight, window start, ttl. Returns
+# {admitted (1), queue full (0) or session full (-1), queue depth, tasks
+# finished since the window start}.
+ADMIT_TASK_LUA = """
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", ARGV[3])
+redis.call("ZREMRANGEBYSCORE", KEYS[2], "-inf", ARGV[3])
+local depth = redis.call("ZCARD", KEYS[1])
+local completed = redis.call("ZCOUNT", KEYS[3], ARGV[6], "+inf")
+if depth >= tonumber(ARGV[4]) then
+    return {0, depth, completed}
+end
+if redis.call("ZCARD", KEYS[2]) >= tonumber(ARGV[5]) then
+    return {-1, depth, completed}
+end
+redis.call("ZADD", KEYS[1], ARGV[2], ARGV[1])
+redis.call("ZADD", KEYS[2], ARGV[2], ARGV[1])
+redis.call("EXPIRE", KEYS[2], ARGV[7])
+return {1, depth + 1, completed}
+"""
+
+# KEYS: inflight, session inflight, cancel flag, watchers. ARGV: task id,
+# ttl, session id. Cancels an admitted task: sets its flag and frees its slots.
+# A watcher of a shared task only stops watching it, and the task is cancelled
+# once no watcher is left; other tasks can only be cancelled by the session
+# that queued them. Returns 1, or 0 if the session has no such task in flight.
+CANCEL_TASK_LUA = """
+if redis.call("HEXISTS", KEYS[4], ARGV[3]) == 1 then
+    if not redis.call("ZSCORE", KEYS[1], ARGV[1]) then
+        return 0
+    end
+    if redis.call("HINCRBY", KEYS[4], ARGV[3], -1) <= 0 then
+        redis.call("HDEL", KEYS[4], ARGV[3])
+    end
+    if redis.call("HLEN", KEYS[4]) > 0 then
+        return 1
+    end
+elseif not redis.call("ZSCORE", KEYS[2], ARGV[1]) then
+    return 0
+end
+redis.call("SET", KEYS[3], "1", "EX", ARGV[2])
+redis.call("ZREM", KEYS[1], ARGV[1])
+redis.call("ZREM", KEYS[2], ARGV[1])
+return 1
+"""
+
+# KEYS: inflight, session inflight, completed. ARGV: task id, now, window
+# start.
+RELEASE_TASK_LUA = """
+local removed = redis.call("ZREM", KEYS[1], ARGV[1])
+redis.call("ZREM", KEYS[2], ARGV[1])
+if removed == 1 then
+    redis.call("ZADD", KEYS[3], ARGV[2], ARGV[1])
+end
+redis.call("ZREMRANGEBYSCORE", KEYS[3], "-inf", ARGV[3])
+"""
+
+GET_MODEL_RECIPE_SCRIPT = redis_client.register_script(GET_MODEL_RECIPE_LUA)
+ASYNC_GET_MODEL_RECIPE_SCRIPT = async_redis_client.register_script(
+    GET_MODEL_RECIPE_LUA
+)
+ASYNC_SESSION_MODELS_SCRIPT = async_redis_client.register_script(SESSION_MODELS_LUA)
+ASYNC_ALLOCATE_MODEL_NAME_SCRIPT = async_redis_client.register_script(
+    ALLOCATE_MODEL_NAME_LUA
+)
+ASYNC_CLAIM_RESPONSE_SCRIPT = async_redis_client.register_script(CLAIM_RESPONSE_LUA)
+ASYNC_ADMIT_TASK_SCRIPT = async_redis_client.register_script(ADMIT_TASK_LUA)
+RELEASE_TASK_SCRIPT = redis_client.register_script(RELEASE_TASK_LUA)
+ASYNC_CANCEL_TASK_SCRIPT = async_redis_client.register_script(CANCEL_TASK_LUA)
 
 
-def get_model_recipe(session_id: str, model_name: str):
+def session_key(session_id: str) -> str:
+    return f"session:{session_id}"
+
+
+def recipe_key(recipe_id: str) -> str:
+    return f"recipe:{recipe_id}"
+
+
+def get_model_recipe(
+    session_id: str, model_name: str, ttl_seconds: int = SESSION_TTL_SECONDS
+):
     try:
-        recipe_key = f"model:{session_id}:{model_name}"
-        recipe = redis_client.json().get(recipe_key, "$")
-        if recipe and len(recipe) > 0:
-            return recipe[0]
+        recipe = GET_MODEL_RECIPE_SCRIPT(
+            keys=[session_key(session_id)],
+            args=[model_name, ttl_seconds],
+            client=redis_client,
+        )
+        return json.loads(recipe) if recipe is not None else None
+    except Exception as e:
+        print(f"Error getting model recipe: {e}")
         return None
+
+
+def get_model_recipe_default(session_id: str, model_name: str):
+    """Recipe for a parent (built locally) or a session's merged child."""
+    if model_name in BASE_MODELS_NAMES:
+        return base_model_recipe(model_name)
+    return get_model_recipe(session_id, model_name)
+
+
+async def async_get_session_models(
+    session_id: str, ttl_seconds: int = SESSION_TTL_SECONDS
+):
+    try:
+        return await ASYNC_SESSION_MODELS_SCRIPT(
+            keys=[session_key(session_id)],
+            args=[ttl_seconds],
+            client=async_redis_client,
+        )
+    except Exception as e:
+        print(f"Error getting session models: {e}")
+        return []
+
+
+async def async_get_model_recipe(
+    session_id: str, model_name: str, ttl_seconds: int = SESSION_TTL_SECONDS
+):
+    try:
+        recipe = await ASYNC_GET_MODEL_RECIPE_SCRIPT(
+            keys=[session_key(session_id)],
+            args=[model_name, ttl_seconds],
+            client=async_redis_client,
+        )
+        return json.loads(recipe) if recipe is not None else None
     except Exception as e:
         print(f"Error getting model recipe: {e}")
         return None
 
 
-def delete_session(session_id: str):
-    model_names = get_session_models(session_id)
+async def async_get_model_recipe_default(session_id: str, model_name: str):
+    if model_name in BASE_MODELS_NAMES:
+        return base_model_recipe(model_name)
+    return await async_get_model_recipe(session_id, model_name)
+
+
+async def async_allocate_model_name(
+    session_id: str,
+    base_name: str,
+    recipe: dict,
+    attempts: int = 20,
+    ttl_seconds: int = SESSION_TTL_SECONDS,
+):
+    """Atomically save ``recipe`` under the first free ``<base_name>_<i>``.
+
+    The recipe is stored once under its content hash, so sessions that save
+    the same recipe share one copy. Returns the allocated name, or None if all
+    ``attempts`` names are taken.
+    """
+    recipe = canonicalize_recipe(recipe)
+    recipe_id = recipe_hash(recipe)
+    return await ASYNC_ALLOCATE_MODEL_NAME_SCRIPT(
+        keys=[session_key(session_id), recipe_key(recipe_id)],
+        args=[base_name, attempts, recipe_id, json.dumps(recipe), ttl_seconds],
+        client=async_redis_client,
+    )
+
+
+async def async_delete_session(session_id: str):
+    # Recipes are shared between sessions and expire on their own.
+    await async_redis_client.delete(session_key(session_id))
+
+
+def response_key(recipe_id: str, prompt: str, max_new_tokens: int) -> str:
+    """Key of a deterministic (greedy) generation, which these fully determine."""
+    payload = json.dumps([recipe_id, prompt, max_new_tokens], separators=(",", ":"))
+    return f"response:{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+
+async def async_claim_response(
+    key: str,
+    task_id: str,
+    session_id: str,
+    ttl_seconds: int,
+    stale_task_id: str = "",
+    attach: bool = True,
+):
+    """The id of the task already answering request ``key`` (queued, running or
+    finished), or None after making ``task_id`` that task.
+
+    The session watches the task it claims and, with ``attach``, the one
+    returned (see ``async_cancel_task``). Pass a failed task's id as
+    ``stale_task_id`` to replace it.
+    """
+    return await ASYNC_CLAIM_RESPONSE_SCRIPT(
+        keys=[key],
+        args=[task_id, ttl_seconds, stale_task_id, session_id, "1" if attach else ""],
+        client=async_redis_client,
+    )
+
+
+def session_inflight_key(session_id: str) -> str:
+    return f"admission:session:{session_id}"
+
+
+async def async_admit_task(
+    task_id: str,
+    session_id: str,
+    max_queue_depth: int,
+    max_session_inflight: int,
+    stale_seconds: int,
+):
+    """Atomically admit an inference task unless the queue or the session is
+    full.
+
+    Returns ``(status, queue depth, tasks finished per second)``, where status
+    is 1 when admitted, 0 when the queue is full and -1 when the session has
+    too many tasks in flight. Throughput is measured over the last
+    ``ADMISSION_WINDOW_SECONDS``.
+    """
+    now = time.time()
+    status, depth, completed = await ASYNC_ADMIT_TASK_SCRIPT(
+        keys=[
+            ADMISSION_INFLIGHT_KEY,
+            session_inflight_key(session_id),
+            ADMISSION_COMPLETED_KEY,
+        ],
+        args=[
+            task_id,
+            now,
+            now - stale_seconds,
+            max_queue_depth,
+            max_session_inflight,
+            now - ADMISSION_WINDOW_SECONDS,
+            stale_seconds,
+        ],
+        client=async_redis_client,
+    )
+    return status, depth, completed / ADMISSION_WINDOW_SECONDS
+
+
+async def async_is_task_admitted(task_id: str, stale_seconds: int) -> bool:
+    """Whether a task is admitted and in flight, and not yet presumed lost."""
+    admitted = await async_redis_client.zscore(ADMISSION_INFLIGHT_KEY, task_id)
+    return admitted is not None and admitted >= time.time() - stale_seconds
+
+
+async def async_release_task(task_id: str, session_id: str):
+    """Drop an admitted task that was never queued, without counting it as
+    finished."""
+    async with async_redis_client.pipeline(transaction=True) as pipe:
+        pipe.zrem(ADMISSION_INFLIGHT_KEY, task_id)
+        pipe.zrem(session_inflight_key(session_id), task_id)
+        await pipe.execute()
+
+
+def release_task(task_id: str, session_id: str):
+    """Mark an admitted task finished, freeing its slots and counting it
+    toward throughput. Tasks that were never admitted are ignored."""
+    now = time.time()
+    RELEASE_TASK_SCRIPT(
+        keys=[
+            ADMISSION_INFLIGHT_KEY,
+            session_inflight_key(session_id),
+            ADMISSION_COMPLETED_KEY,
+        ],
+        args=[task_id, now, now - ADMISSION_WINDOW_SECONDS],
+        client=redis_client,
+    )
+
+
+def cancel_key(task_id: str) -> str:
+    return f"cancel:{task_id}"
+
+
+def watchers_key(task_id: str) -> str:
+    return f"watchers:{task_id}"
+
+
+async def async_cancel_task(task_id: str, session_id: str) -> bool:
+    """Ask the worker to stop (or never start) one of this session's tasks.
+
+    A task shared through the response cache is only cancelled once every
+    request watching it has been cancelled; until then this just drops the
+    session's request. Other tasks can only be cancelled by the session that
+    queued them. Returns whether the task was in flight.
+    """
+    cancelled = await ASYNC_CANCEL_TASK_SCRIPT(
+        keys=[
+            ADMISSION_INFLIGHT_KEY,
+            session_inflight_key(session_id),
+            cancel_key(task_id),
+            watchers_key(task_id),
+        ],
+        args=[task_id, CANCEL_TTL_SECONDS, session_id],
+        client=async_redis_client,
+    )
+    return bool(cancelled)
+
+
+def is_task_cancelled(task_id: str) -> bool:
+    return bool(redis_client.exists(cancel_key(task_id)))
+
+
+async def async_is_task_cancelled(task_id: str) -> bool:
+    return bool(await async_redis_client.exists(cancel_key(task_id)))
+
+
+def mark_worker_ready(worker_name: str, ttl_seconds: int = 30):
+    redis_client.set(f"worker:ready:{worker_name}", "1", ex=ttl_seconds)
+
+
+def clear_worker_ready(worker_name: str):
+    redis_client.delete(f"worker:ready:{worker_name}")
+
+
+async def async_get_ready_workers():
+    return [
+        key.removeprefix("worker:ready:")
+        async for key in async_redis_client.scan_iter(match="worker:ready:*")
+    ]
+
+
+def stream_channel(task_id: str) -> str:
+    return f"stream:{task_id}"
 
-    for model_name in model_names:
-        recipe_key = f"model:{session_id}:{model_name}"
-        redis_client.delete(recipe_key)
 
-    session_key = f"session:{session_id}:models"
-    redis_client.delete(session_key)
+def publish_stream_event(task_id: str, event: str, data: dict):
+    redis_client.publish(
+        stream_channel(task_id), json.dumps({"event": event, "data": data})
+    )
@@ -0,0 +1,635 @@
+import fcntl
+import json
+import math
+import os
+import struct
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import torch
+import torch.nn as nn
+from accelerate import init_empty_weights
+from safetensors.torch import save_file
+from transformers import AutoConfig, AutoModelForCausalLM
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+SAFETENSORS_DTYPE_NAMES = {dtype: name for name, dtype in SAFETENSORS_DTYPES.items()}
+
+
+class LayerStack:
+    """Transformer blocks of every base model packed into one contiguous buffer.
+
+    ``buffer`` has shape ``[model, layer, numel]``; each row is the flattened
+    parameters of one ``GPT2Block``. Once a model is packed its block parameters
+    are rebound to views of the buffer, so packing costs no extra memory and
+    merging becomes a handful of fused multiply-adds over flat rows instead of
+    per-key tensor arithmetic.
+    """
+
+    def __init__(
+        self,
+        model_names: Sequence[str],
+        block: nn.Module,
+        n_layers: int,
+        dtype: torch.dtype = torch.float32,
+        device: str = "cpu",
+        buffer: Optional[torch.Tensor] = None,
+    ):
+        self.model_index = {name: i for i, name in enumerate(model_names)}
+        self.n_layers = n_layers
+        self.layout: List[Tuple[str, int, int, torch.Size]] = []
+        offset = 0
+        for key, param in block.named_parameters():
+            self.layout.append((key, offset, param.numel(), param.shape))
+            offset += param.numel()
+        self.numel = offset
+        if buffer is None:
+            buffer = torch.empty(
+                len(model_names), n_layers, self.numel, dtype=dtype, device=device
+            )
+        self.buffer = buffer
+
+    def pack(self, name: str, model: nn.Module) -> None:
+        """Copy ``model``'s blocks into the buffer and rebind them as views."""
+        m = self.model_index[name]
+        for layer, block in enumerate(model.transformer.h):
+            params = dict(block.named_parameters())
+            views = self.layer_state_dict(self.buffer[m, layer])
+            for key, view in views.items():
+                view.copy_(params[key].data)
+                params[key].data = view
+
+    def layer(self, name: str, idx: int) -> torch.Tensor:
+        return self.buffer[self.model_index[name], idx]
+
+    def layer_state_dict(self, flat: torch.Tensor) -> Dict[str, torch.Tensor]:
+        """View a flat block row as a ``GPT2Block`` state dict."""
+        return {
+            key: flat[offset : offset + numel].view(shape)
+            for key, offset, numel, shape in self.layout
+        }
+
+    def is_view(self, terms: List[Tuple[int, str, float]]) -> bool:
+        """Whether a child layer is a pure copy that can alias the buffer."""
+        return len(terms) == 1 and terms[0][2] == 1.0
+
+    def accumulate(
+        self, acc: torch.Tensor, terms: List[Tuple[int, str, float]]
+    ) -> None:
+        """Write the weighted sum of ``terms`` into the flat row ``acc``."""
+        if not terms:
+            acc.zero_()
+        for t, (idx, name, alpha) in enumerate(terms):
+            if t > 0:
+                acc.add_(self.layer(name, idx), alpha=alpha)
+            elif acc.dtype == self.buffer.dtype:
+                torch.mul(self.layer(name, idx), alpha, out=acc)
+            else:
+                acc.copy_(self.layer(name, idx)).mul_(alpha)
+
+    def merge_layers(
+        self, layer_recipe: List[List[Tuple[int, str, float]]]
+    ) -> List[torch.Tensor]:
+        """Flat parameters for every child layer of a recipe.
+
+        Pure-copy layers (a single term with alpha 1.0) are returned as views of
+        the buffer. All other layers are written into a single
+        ``[n_merged, numel]`` allocation with one multiply-add per term.
+        """
+        merged_rows = [
+            i for i, terms in enumerate(layer_recipe) if not self.is_view(terms)
+        ]
+        out = torch.empty(
+            len(merged_rows),
+            self.numel,
+            dtype=self.buffer.dtype,
+            device=self.buffer.device,
+        )
+        # Low-precision buffers are summed in an fp32 scratch row and rounded
+        # once, so many-term merges do not pile up rounding errors.
+        acc_dtype = torch.promote_types(self.buffer.dtype, torch.float32)
+        scratch = None
+        if merged_rows and acc_dtype != self.buffer.dtype:
+            scratch = torch.empty(
+                self.numel, dtype=acc_dtype, device=self.buffer.device
+            )
+
+        layers = []
+        row = 0
+        for i, terms in enumerate(layer_recipe):
+            if row < len(merged_rows) and merged_rows[row] == i:
+                dst = out[row]
+                row += 1
+                acc = dst if scratch is None else scratch
+                self.accumulate(acc, terms)
+                if acc is not dst:
+                    dst.copy_(acc)
+                layers.append(dst)
+            else:
+                idx, name, _ = terms[0]
+                layers.append(self.layer(name, idx))
+        return layers
+
+
+Delta = Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]
+
+
+def compress_delta(delta: torch.Tensor, rank: int = 0, rtol: float = 0.0) -> Delta:
+    """A weight delta as-is, or as low-rank factors ``(a, b)`` with ``a @ b ≈ delta``.
+
+    ``rtol`` keeps the fewest singular values whose dropped part is at most
+    ``rtol`` of the delta's Frobenius norm; ``rank`` caps the rank kept. Only
+    2-D weights are factored, and only when the factors are smaller.
+    """
+    if delta.dim() != 2 or (rank <= 0 and rtol <= 0):
+        return delta
+    u, s, vh = torch.linalg.svd(delta.float(), full_matrices=False)
+    r = s.numel()
+    if rtol > 0:
+        # tail[i] is the squared norm dropped by keeping only the first i values.
+        tail = s.square().flip(0).cumsum(0).flip(0)
+        r = int((tail > rtol**2 * tail[0]).sum())
+    if rank > 0:
+        r = min(r, rank)
+    if r * sum(delta.shape) >= delta.numel():
+        return delta
+    a = (u[:, :r] * s[:r]).to(delta.dtype).contiguous()
+    b = vh[:r].to(delta.dtype).contiguous()
+    return a, b
+
+
+class DeltaStack(LayerStack):
+    """Blocks stored as one pretrained base plus a delta per fine-tuned model.
+
+    ``buffer`` holds only the base, as ``[1, layer, numel]``. ``deltas[name]``
+    has one ``{key: delta}`` dict per layer, where a delta is a dense tensor or
+    low-rank factors (see ``compress_delta``) and unchanged keys are absent.
+    Every child layer is materialized, since none is a plain buffer view.
+    """
+
+    def __init__(
+        self,
+        model_names: Sequence[str],
+        block: nn.Module,
+        n_layers: int,
+        base: torch.Tensor,
+        deltas: Dict[str, List[Dict[str, Delta]]],
+    ):
+        super().__init__(model_names, block, n_layers, buffer=base.unsqueeze(0))
+        self.deltas = deltas
+
+    def is_view(self, terms: List[Tuple[int, str, float]]) -> bool:
+        return False
+
+    def layer(self, name: str, idx: int) -> torch.Tensor:
+        acc_dtype = torch.promote_types(self.buffer.dtype, torch.float32)
+        flat = torch.empty(self.numel, dtype=acc_dtype, device=self.buffer.device)
+        self.accumulate(flat, [(idx, name, 1.0)])
+        return flat.to(self.buffer.dtype)
+
+    def accumulate(
+        self, acc: torch.Tensor, terms: List[Tuple[int, str, float]]
+    ) -> None:
+        acc.zero_()
+        for idx, _, alpha in terms:
+            acc.add_(self.buffer[0, idx], alpha=alpha)
+        views = self.layer_state_dict(acc)
+        for idx, name, alpha in terms:
+            for key, delta in self.deltas[name][idx].items():
+                if isinstance(delta, tuple):
+                    a, b = delta
+                    views[key].addmm_(a.to(acc.dtype), b.to(acc.dtype), alpha=alpha)
+                else:
+                    views[key].add_(delta, alpha=alpha)
+
+
+def mmap_safetensors(path: str) -> Tuple[Dict[str, torch.Tensor], Dict[str, str]]:
+    """Open a safetensors file as tensors backed by one mmap of the file.
+
+    Unlike ``safetensors.safe_open``, which copies into private memory, every
+    process that opens the same file maps the same page-cache pages, so the
+    weights are resident once per machine rather than once per process.
+    """
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    metadata = header.pop("__metadata__", {})
+
+    storage = torch.UntypedStorage.from_file(
+        path, shared=False, nbytes=os.path.getsize(path)
+    )
+    raw = torch.empty(0, dtype=torch.uint8).set_(storage)
+
+    start = 8 + header_size
+    tensors = {}
+    for name, info in header.items():
+        begin, end = info["data_offsets"]
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        tensors[name] = raw[start + begin : start + end].view(dtype).view(info["shape"])
+    return tensors, metadata
+
+
+@contextmanager
+def file_lock(path: str):
+    """Exclusive advisory lock, used so only one worker process exports the store."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(f"{path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _read_header(path: str) -> Optional[dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        return json.loads(f.read(header_size))
+
+
+def base_store_models(path: str) -> Optional[List[str]]:
+    """Model names recorded in an existing base store, or None if there is none."""
+    header = _read_header(path)
+    if header is None:
+        return None
+    return json.loads(header.get("__metadata__", {}).get("models", "null"))
+
+
+def base_store_dtype(path: str) -> Optional[torch.dtype]:
+    """Dtype of the packed blocks in an existing base store, or None."""
+    header = _read_header(path)
+    if header is None:
+        return None
+    return SAFETENSORS_DTYPES[header["h"]["dtype"]]
+
+
+def base_store_format(path: str) -> Optional[dict]:
+    """How an existing base store holds blocks, e.g. ``{"type": "full"}``, or None."""
+    header = _read_header(path)
+    if header is None:
+        return None
+    metadata = header.get("__metadata__", {})
+    return json.loads(metadata.get("format", '{"type": "full"}'))
+
+
+def read_metadata(path: str) -> Optional[Dict[str, str]]:
+    """The metadata of an existing safetensors file, or None if there is none."""
+    header = _read_header(path)
+    if header is None:
+        return None
+    return header.get("__metadata__", {})
+
+
+def base_store_id(path: str) -> Optional[str]:
+    """Id of the export that wrote an existing base store, or None."""
+    metadata = read_metadata(path)
+    return metadata.get("id") if metadata is not None else None
+
+
+def _non_block_tensors(name: str, model: nn.Module) -> Dict[str, torch.Tensor]:
+    """Every parameter outside the blocks, as ``<model>.<key>``, tied ones once."""
+    tensors = {}
+    seen = set()
+    for key, tensor in model.state_dict().items():
+        if key.startswith("transformer.h.") or tensor.data_ptr() in seen:
+            continue
+        seen.add(tensor.data_ptr())
+        tensors[f"{name}.{key}"] = tensor.contiguous()
+    return tensors
+
+
+def _save_store(path: str, tensors: Dict[str, torch.Tensor], metadata: dict) -> None:
+    tmp_path = f"{path}.tmp"
+    # A fresh id per export tells apart stores that are otherwise alike, e.g.
+    # after the parents were downloaded again.
+    metadata = {**metadata, "id": uuid.uuid4().hex}
+    save_file(tensors, tmp_path, metadata=metadata)
+    os.replace(tmp_path, path)
+
+
+def save_file_streaming(
+    path: str,
+    specs: Sequence[Tuple[str, torch.dtype, Sequence[int]]],
+    tensors: Iterable[torch.Tensor],
+    metadata: Optional[Dict[str, str]] = None,
+) -> None:
+    """Write a safetensors file one tensor at a time.
+
+    ``specs`` gives every tensor's ``(name, dtype, shape)`` up front, so the
+    header can be written first; ``tensors`` then yields the tensors in the
+    same order. Only the tensor being written has to be in memory, so a
+    generator can build each one just before it is needed and drop it after.
+    """
+    header = {}
+    if metadata:
+        header["__metadata__"] = metadata
+    offset = 0
+    for name, dtype, shape in specs:
+        nbytes = math.prod(shape) * torch.empty(0, dtype=dtype).element_size()
+        header[name] = {
+            "dtype": SAFETENSORS_DTYPE_NAMES[dtype],
+            "shape": list(shape),
+            "data_offsets": [offset, offset + nbytes],
+        }
+        offset += nbytes
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    # The data section starts 8-byte aligned, padded with spaces as the
+    # reference writer does.
+    header_bytes += b" " * (-len(header_bytes) % 8)
+
+    # Other processes or threads may be writing the same file.
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for (name, dtype, shape), tensor in zip(specs, tensors, strict=True):
+            if tensor.dtype != dtype or tuple(tensor.shape) != tuple(shape):
+                raise ValueError(f"{name}: expected {dtype} {tuple(shape)}")
+            data = tensor.detach().contiguous().cpu().view(-1).view(torch.uint8)
+            f.write(data.numpy().data)
+    os.replace(tmp_path, path)
+
+
+def export_base_store(path: str, models: Dict[str, nn.Module]) -> None:
+    """Write base models to a single safetensors file.
+
+    Blocks are stored packed as ``h`` (see ``LayerStack``); every other
+    parameter is stored as ``<model>.<key>``. Configs go in the metadata so the
+    store can be loaded without touching the hub.
+    """
+    names = list(models)
+    first = models[names[0]]
+    stack = LayerStack(
+        names, first.transformer.h[0], first.config.n_layer, dtype=first.dtype
+    )
+    tensors = {"h": stack.buffer}
+    configs = {}
+    for name, model in models.items():
+        stack.pack(name, model)
+        configs[name] = model.config.to_dict()
+        tensors.update(_non_block_tensors(name, model))
+
+    _save_store(
+        path,
+        tensors,
+        {
+            "models": json.dumps(names),
+            "configs": json.dumps(configs),
+            "format": json.dumps({"type": "full"}),
+        },
+    )
+
+
+def export_delta_store(
+    path: str,
+    base: nn.Module,
+    models: Dict[str, nn.Module],
+    rank: int = 0,
+    rtol: float = 0.0,
+) -> None:
+    """Write fine-tunes of ``base`` as the base's weights plus per-model deltas.
+
+    The base blocks are stored packed as ``h`` (one model) and its other
+    parameters as ``base.<key>``. Each model's block deltas are stored as
+    ``<model>.delta.<layer>.<key>`` and its other deltas as
+    ``<model>.delta.<key>``, or as ``.a``/``.b`` factors when
+    ``compress_delta`` factors them with ``rank``/``rtol``. Keys a fine-tune
+    left unchanged are not stored. Dense deltas are as large as the weights
+    they replace, so the store only gets smaller than ``export_base_store``'s
+    when fine-tunes leave weights unchanged or their deltas are compressed.
+    """
+    names = list(models)
+    stack = LayerStack(
+        ["base"], base.transformer.h[0], base.config.n_layer, dtype=base.dtype
+    )
+    stack.pack("base", base)
+    tensors = {"h": stack.buffer}
+    base_tensors = _non_block_tensors("base", base)
+    tensors.update(base_tensors)
+
+    def put_delta(prefix, tensor, base_tensor):
+        delta = tensor.float() - base_tensor.float()
+        if not delta.any():
+            return
+        delta = compress_delta(delta, rank, rtol)
+        if isinstance(delta, tuple):
+            tensors[f"{prefix}.a"] = delta[0].to(base.dtype)
+            tensors[f"{prefix}.b"] = delta[1].to(base.dtype)
+        else:
+            tensors[prefix] = delta.to(base.dtype).contiguous()
+
+    configs = {}
+    for name, model in models.items():
+        configs[name] = model.config.to_dict()
+        for key, tensor in _non_block_tensors(name, model).items():
+            key = key.removeprefix(f"{name}.")
+            put_delta(f"{name}.delta.{key}", tensor, base_tensors[f"base.{key}"])
+        for layer, block in enumerate(model.transformer.h):
+            base_params = dict(base.transformer.h[layer].named_parameters())
+            for key, param in block.named_parameters():
+                put_delta(f"{name}.delta.{layer}.{key}", param.data, base_params[key])
+
+    _save_store(
+        path,
+        tensors,
+        {
+            "models": json.dumps(names),
+            "configs": json.dumps(configs),
+            "format": json.dumps({"type": "delta", "rank": rank, "rtol": rtol}),
+        },
+    )
+
+
+def _load_deltas(
+    tensors: Dict[str, torch.Tensor], name: str, stack: LayerStack
+) -> List[Dict[str, Delta]]:
+    deltas = []
+    for layer in range(stack.n_layers):
+        layer_deltas = {}
+        for key, _, _, _ in stack.layout:
+            prefix = f"{name}.delta.{layer}.{key}"
+            if prefix in tensors:
+                layer_deltas[key] = tensors[prefix]
+            elif f"{prefix}.a" in tensors:
+                layer_deltas[key] = (tensors[f"{prefix}.a"], tensors[f"{prefix}.b"])
+        deltas.append(layer_deltas)
+    return deltas
+
+
+def _load_non_block(
+    tensors: Dict[str, torch.Tensor], name: str, key: str
+) -> Optional[torch.Tensor]:
+    """A delta store parameter outside the blocks: the base's, shared by every
+    model that left it unchanged, or the base plus the model's delta."""
+    if f"{name}.{key}" in tensors:
+        # Stores written before non-block deltas hold these in full.
+        return tensors[f"{name}.{key}"]
+    if f"base.{key}" not in tensors:
+        return None
+    base = tensors[f"base.{key}"]
+    prefix = f"{name}.delta.{key}"
+    if prefix in tensors:
+        delta = tensors[prefix].float()
+    elif f"{prefix}.a" in tensors:
+        delta = tensors[f"{prefix}.a"].float() @ tensors[f"{prefix}.b"].float()
+    else:
+        return base
+    return (base.float() + delta).to(base.dtype)
+
+
+def load_base_store(
+    path: str, device: str = "cpu"
+) -> Tuple[LayerStack, Dict[str, nn.Module]]:
+    """Open a base store written by ``export_base_store`` or ``export_delta_store``.
+
+    The returned models and ``LayerStack`` are views over the mapped file; on
+    CPU nothing is copied. For a delta store the stack is a ``DeltaStack`` and
+    the models' blocks stay on the meta device: only the stack can build them.
+    Their other parameters are the base's where unchanged, and otherwise built
+    from the base and delta at load.
+    """
+    tensors, metadata = mmap_safetensors(path)
+    names = json.loads(metadata["models"])
+    configs = json.loads(metadata["configs"])
+    is_delta = json.loads(metadata.get("format", "{}")).get("type") == "delta"
+    if device != "cpu":
+        tensors = {key: tensor.to(device) for key, tensor in tensors.items()}
+
+    models = {}
+    stack = None
+    for name in names:
+        config_dict = dict(configs[name])
+        config = AutoConfig.for_model(config_dict.pop("model_type"), **config_dict)
+        with init_empty_weights():
+            model = AutoModelForCausalLM.from_config(config)
+        model.eval()
+
+        if stack is None and is_delta:
+            stack = DeltaStack(
+                names, model.transformer.h[0], config.n_layer, tensors["h"][0], {}
+            )
+        elif stack is None:
+            stack = LayerStack(
+                names, model.transformer.h[0], config.n_layer, buffer=tensors["h"]
+            )
+
+        state_dict = {}
+        for key in model.state_dict():
+            if key.startswith("transformer.h."):
+                continue
+            if is_delta:
+                tensor = _load_non_block(tensors, name, key)
+                if tensor is not None:
+                    state_dict[key] = tensor
+            elif f"{name}.{key}" in tensors:
+                state_dict[key] = tensors[f"{name}.{key}"]
+        if config.tie_word_embeddings:
+            state_dict["lm_head.weight"] = state_dict["transformer.wte.weight"]
+        if is_delta:
+            stack.deltas[name] = _load_deltas(tensors, name, stack)
+        else:
+            for layer in range(config.n_layer):
+                views = stack.layer_state_dict(stack.layer(name, layer))
+                for key, view in views.items():
+                    state_dict[f"transformer.h.{layer}.{key}"] = view
+
+        model.load_state_dict(state_dict, assign=True, strict=not is_delta)
+        model.tie_weights()
+        model.requires_grad_(False)
+        models[name] = model
+    return stack, models
+
+
+def save_child_store(
+    path: str, model: nn.Module, stack: LayerStack, recipe: dict
+) -> None:
+    """Write a merged child so ``load_child_store`` can map it back.
+
+    Blocks that are plain views of ``stack`` (see ``LayerStack.is_view``) are
+    not stored, since loading aliases them again. Every other block is stored as
+    one flat row ``h.<i>``; other parameters as ``child.<key>``, tied ones once.
+    """
+    tensors = _non_block_tensors("child", model)
+    specs = [(key, tensor.dtype, tensor.shape) for key, tensor in tensors.items()]
+    merged = [
+        i for i, terms in enumerate(recipe["layer_recipe"]) if not stack.is_view(terms)
+    ]
+    specs += [(f"h.{i}", stack.buffer.dtype, (stack.numel,)) for i in merged]
+
+    def rows():
+        yield from tensors.values()
+        for i in merged:
+            params = dict(model.transformer.h[i].named_parameters())
+            yield torch.cat([params[key].reshape(-1) for key, *_ in stack.layout])
+
+    save_file_streaming(
+        path,
+        specs,
+        rows(),
+        {
+            "config": json.dumps(model.config.to_dict()),
+            "recipe": json.dumps(recipe),
+            "format": json.dumps({"type": "child"}),
+        },
+    )
+
+
+def load_child_store(
+    path: str,
+    stack: LayerStack,
+    device: str = "cpu",
+    block: Optional[Callable[[list, torch.Tensor], torch.Tensor]] = None,
+) -> nn.Module:
+    """Open a child written by ``save_child_store``.
+
+    On CPU its stored tensors are views of one mapping of the file and its
+    pure-copy blocks alias ``stack``, so loading copies nothing. ``block`` is
+    called with each stored block's layer recipe and flat row, and returns the
+    row to use instead, e.g. an identical block already in memory.
+    """
+    tensors, metadata = mmap_safetensors(path)
+    recipe = json.loads(metadata["recipe"])
+    config_dict = json.loads(metadata["config"])
+    config = AutoConfig.for_model(config_dict.pop("model_type"), **config_dict)
+    if device != "cpu":
+        tensors = {key: tensor.to(device) for key, tensor in tensors.items()}
+
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(config)
+    model.eval()
+
+    state_dict = {}
+    for key in model.state_dict():
+        if f"child.{key}" in tensors:
+            state_dict[key] = tensors[f"child.{key}"]
+    if config.tie_word_embeddings:
+        state_dict["lm_head.weight"] = state_dict["transformer.wte.weight"]
+    for i, terms in enumerate(recipe["layer_recipe"]):
+        if f"h.{i}" in tensors:
+            flat = tensors[f"h.{i}"]
+            if block is not None:
+                flat = block(terms, flat)
+        else:
+            idx, name, _ = terms[0]
+            flat = stack.layer(name, idx)
+        for key, view in stack.layer_state_dict(flat).items():
+            state_dict[f"transformer.h.{i}.{key}"] = view
+
+    model.load_state_dict(state_dict, assign=True)
+    model.tie_weights()
+    model.requires_grad_(False)
+    model.merge_recipe = recipe
+    return model
@@ -2,73 +2,310 @@ import os
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
-from celery import Celery
-from celery.exceptions import InvalidTaskError
+import copy
+import hashlib
+import json
+import socket
+import threading
+import weakref
+from celery import Celery, states
+from celery.exceptions import Ignore, InvalidTaskError, TaskRevokedError
+from celery.signals import worker_init, worker_ready, worker_shutdown
+from kombu import Queue
 import torch
 import torch.nn as nn
 from dotenv import load_dotenv
 from evolutiontransformer.redis import (
-    add_model_to_session,
-    get_session_models,
-    save_model_recipe,
-    get_model_recipe,
-    delete_session,
+    get_model_recipe_default,
+    is_task_cancelled,
+    mark_worker_ready,
+    clear_worker_ready,
+    publish_stream_event,
+    release_task,
 )
-
-
-from transformers import AutoConfig, AutoTokenizer, AutoModelForCausalLM
-from typing import List, Tuple
-from tqdm import tqdm
+from evolutiontransformer.recipes import (
+    BASE_MODELS_NAMES,
+    canonicalize_layer,
+    canonicalize_recipe,
+    changed_parts,
+    recipe_hash,
+    recipe_parts,
+)
+from evolutiontransformer.cache import (
+    BlockCache,
+    DiskCache,
+    ModelCache,
+    PrefixCache,
+    compact_kv_cache,
+    storage_ptrs,
+)
+from evolutiontransformer.store import (
+    base_store_dtype,
+    base_store_format,
+    base_store_id,
+    base_store_models,
+    export_base_store,
+    export_delta_store,
+    file_lock,
+    load_base_store,
+    load_child_store,
+    read_metadata,
+    save_child_store,
+    save_file_streaming,
+)
+from evolutiontransformer.memory import process_memory
+from evolutiontransformer.quantize import quantize_model, upcast_model
+from evolutiontransformer.batching import BatchScheduler
+
+
+from accelerate import init_empty_weights
+from transformers import (
+    AutoConfig,
+    AutoTokenizer,
+    AutoModelForCausalLM,
+    LogitsProcessor,
+    LogitsProcessorList,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextStreamer,
+)
+from typing import Dict, List, Optional, Set, Tuple
 
 load_dotenv()
 
-BASE_MODELS_NAMES = ["svamp", "tinystories"]
 BASE_MODELS = {}
+LAYER_STACK = None
+BASE_STORE_ID = None
+BASE_CONFIGS = {}
 TOKENIZER = None
+TOKENIZER_LOCK = threading.Lock()
+THREAD_TOKENIZERS = threading.local()
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+MODEL_CACHE_MB = int(os.getenv("MODEL_CACHE_MB", "3072"))
+BLOCK_CACHE_MB = int(os.getenv("BLOCK_CACHE_MB", "1024"))
+WEIGHT_DTYPES = {"float32": torch.float32, "bfloat16": torch.bfloat16}
+if os.getenv("WEIGHT_DTYPE", "float32") not in WEIGHT_DTYPES:
+    raise ValueError(
+        f"WEIGHT_DTYPE must be one of {', '.join(WEIGHT_DTYPES)}, "
+        f"not {os.getenv('WEIGHT_DTYPE')!r}."
+    )
+WEIGHT_DTYPE = WEIGHT_DTYPES[os.getenv("WEIGHT_DTYPE", "float32")]
+# Dynamic int8 kernels are CPU-only and quantize from fp32 weights.
+INFERENCE_INT8 = (
+    os.getenv("INFERENCE_INT8", "0") == "1"
+    and DEVICE == "cpu"
+    and WEIGHT_DTYPE == torch.float32
+)
+# Set at startup on CPUs without native bf16, where a bf16 child is served from
+# an fp32 copy.
+SERVE_FP32 = False
+PREFIX_CACHE_MB = int(os.getenv("PREFIX_CACHE_MB", "512"))
+PREFIX_CACHE_MIN_TOKENS = int(os.getenv("PREFIX_CACHE_MIN_TOKENS", "32"))
+CANCEL_CHECK_TOKENS = int(os.getenv("CANCEL_CHECK_TOKENS", "8"))
+READY_TTL_SECONDS = 30
+INFERENCE_BATCH_WINDOW_MS = int(os.getenv("INFERENCE_BATCH_WINDOW_MS", "0"))
+INFERENCE_MAX_BATCH_SIZE = int(os.getenv("INFERENCE_MAX_BATCH_SIZE", "8"))
+BASE_STORE_FORMAT = os.getenv("BASE_STORE_FORMAT", "full")
+DELTA_RANK = int(os.getenv("DELTA_RANK", "0"))
+DELTA_RTOL = float(os.getenv("DELTA_RTOL", "0"))
+BASE_STORE_PATH = os.getenv(
+    "BASE_STORE_PATH",
+    os.path.join(
+        os.getenv("HF_HOME", os.path.expanduser("~/.cache")),
+        "evolutiontransformer",
+        "base_models.safetensors",
+    ),
+)
+MERGED_CACHE_MB = int(os.getenv("MERGED_CACHE_MB", "8192"))
+MERGED_CACHE_DIR = os.getenv(
+    "MERGED_CACHE_DIR",
+    os.path.join(
+        os.getenv("HF_HOME", os.path.expanduser("~/.cache")),
+        "evolutiontransformer",
+        "merged",
+    ),
+)
+EXPORT_DIR = os.getenv(
+    "EXPORT_DIR",
+    os.path.join(
+        os.getenv("HF_HOME", os.path.expanduser("~/.cache")),
+        "evolutiontransformer",
+        "exports",
+    ),
+)
+
+BLOCK_CACHE = BlockCache(BLOCK_CACHE_MB * 1024 * 1024)
+# Cached children pay for the blocks they use, each shared block once; blocks
+# no child uses any more are bounded by BLOCK_CACHE's own budget.
+MODEL_CACHE = ModelCache(
+    MODEL_CACHE_MB * 1024 * 1024,
+    shared_storage=lambda: storage_ptrs(BASE_MODELS),
+)
+# Merged children on disk, shared by every worker process and kept across
+# restarts.
+MERGED_CACHE = DiskCache(MERGED_CACHE_DIR, MERGED_CACHE_MB * 1024 * 1024)
+PREFIX_CACHE = PrefixCache(PREFIX_CACHE_MB * 1024 * 1024, PREFIX_CACHE_MIN_TOKENS)
 
 celery_app = Celery(
     "tasks",
     broker=REDIS_URL,
     backend=REDIS_URL,
 )
+celery_app.conf.update(
+    # The API sends short generations to "priority", which is always drained
+    # before the default queue, and workers reserve only one task per slot so
+    # queued short tasks are not held behind long ones.
+    task_queues=(Queue("priority"), Queue("celery")),
+    broker_transport_options={"queue_order_strategy": "priority"},
+    worker_prefetch_multiplier=1,
+)
 
 
 def load_base_models_if_needed():
-    global BASE_MODELS
+    global BASE_MODELS, LAYER_STACK, BASE_STORE_ID, SERVE_FP32
     if not BASE_MODELS:
         print("WORKER: Loading base models into memory...")
-        for model_name in BASE_MODELS_NAMES:
-            model_path = f"tcmmichaelb139/gpt2-medium-{model_name}"
-            model = AutoModelForCausalLM.from_pretrained(model_path)
-            BASE_MODELS[model_name] = model.to(DEVICE)
-
-            if get_model_recipe("default", model_name) is None:
-                add_model_to_session("default", model_name)
-                save_model_recipe(
-                    "default",
-                    model_name,
-                    {
-                        "layer_recipe": [[(i, model_name, 1.0)] for i in range(24)],
-                        "embedding_lambdas": [1.0, 1.0],
-                        "linear_lambdas": [1.0, 1.0],
-                    },
-                )
-
-        print("WORKER: Base models loaded.")
+        with file_lock(BASE_STORE_PATH):
+            if (
+                base_store_models(BASE_STORE_PATH) != BASE_MODELS_NAMES
+                or base_store_dtype(BASE_STORE_PATH) != WEIGHT_DTYPE
+                or base_store_format(BASE_STORE_PATH) != base_store_spec()
+            ):
+                export_base_models()
+        LAYER_STACK, models = load_base_store(BASE_STORE_PATH, DEVICE)
+        BASE_STORE_ID = base_store_id(BASE_STORE_PATH)
+        BASE_MODELS.update(models)
+        if WEIGHT_DTYPE == torch.bfloat16 and DEVICE == "cpu" and not cpu_has_bf16():
+            SERVE_FP32 = True
+            print("WORKER: This CPU has no native bf16; generating in fp32.")
+        if os.getenv("INFERENCE_INT8", "0") == "1" and not INFERENCE_INT8:
+            print(
+                "WORKER: INFERENCE_INT8 is ignored; it needs WEIGHT_DTYPE=float32 "
+                f"on CPU (have {WEIGHT_DTYPE} on {DEVICE})."
+            )
+
+        print(f"WORKER: Base models loaded. Memory (MiB): {process_memory()}")
+
+
+def cpu_has_bf16() -> bool:
+    """Whether oneDNN has fast bf16 kernels on this CPU (AVX-512 or newer)."""
+    return (
+        torch.backends.mkldnn.is_available()
+        and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    )
+
+
+def base_store_spec() -> dict:
+    """The base store format the settings ask for, as recorded in the store."""
+    if BASE_STORE_FORMAT == "delta":
+        return {"type": "delta", "rank": DELTA_RANK, "rtol": DELTA_RTOL}
+    return {"type": "full"}
+
+
+def export_base_models():
+    """Download the parents once and write them to the shared base store."""
+    print(f"WORKER: Exporting {WEIGHT_DTYPE} base models to {BASE_STORE_PATH}...")
+    models = {}
+    for model_name in BASE_MODELS_NAMES:
+        model_path = f"tcmmichaelb139/gpt2-medium-{model_name}"
+        models[model_name] = AutoModelForCausalLM.from_pretrained(
+            model_path, torch_dtype=WEIGHT_DTYPE
+        )
+    if BASE_STORE_FORMAT == "delta":
+        # Both parents are fine-tunes of gpt2-medium.
+        base = AutoModelForCausalLM.from_pretrained(
+            "gpt2-medium", torch_dtype=WEIGHT_DTYPE
+        )
+        export_delta_store(BASE_STORE_PATH, base, models, DELTA_RANK, DELTA_RTOL)
+    else:
+        export_base_store(BASE_STORE_PATH, models)
+
+
+def get_base_config(base_model: str = "gpt2-medium"):
+    if base_model not in BASE_CONFIGS:
+        BASE_CONFIGS[base_model] = AutoConfig.from_pretrained(base_model)
+    return BASE_CONFIGS[base_model]
 
 
 def get_tokenizer():
+    """The tokenizer for the calling thread.
+
+    Fast tokenizers are not thread-safe: encoding with padding changes their
+    state, so concurrent calls from a thread pool fail with "Already borrowed".
+    Each thread gets its own copy of the one loaded tokenizer.
+    """
     global TOKENIZER
-    if TOKENIZER is None:
-        print("WORKER: Initializing Tokenizer...")
-        TOKENIZER = AutoTokenizer.from_pretrained("gpt2-medium")
-    return TOKENIZER
+    tokenizer = getattr(THREAD_TOKENIZERS, "tokenizer", None)
+    if tokenizer is not None:
+        return tokenizer
+    with TOKENIZER_LOCK:
+        if TOKENIZER is None:
+            print("WORKER: Initializing Tokenizer...")
+            TOKENIZER = AutoTokenizer.from_pretrained("gpt2-medium")
+            # Batched generation left-pads with EOS, which decoding then skips.
+            TOKENIZER.pad_token = TOKENIZER.eos_token
+            TOKENIZER.padding_side = "left"
+        tokenizer = copy.deepcopy(TOKENIZER)
+    THREAD_TOKENIZERS.tokenizer = tokenizer
+    return tokenizer
+
+
+class RedisStreamer(TextStreamer):
+    """Publishes generated text to the task's stream channel as it is decoded."""
+
+    def __init__(self, tokenizer, task_id: str):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.task_id = task_id
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        if text:
+            publish_stream_event(self.task_id, "token", {"text": text})
+
+
+def reuse_prefix(recipe_key: str, input_ids: List[int]):
+    """A private copy of the longest cached prefill for this prompt, if any.
+
+    Returns ``(reused tokens, past_key_values)``. At least one prompt token is
+    left uncached, since generate needs an input to produce the next logits.
+    """
+    length, cached = PREFIX_CACHE.longest_prefix(recipe_key, input_ids)
+    length = min(length, len(input_ids) - 1)
+    if cached is None or length <= 0:
+        return 0, None
+    past_key_values = copy.deepcopy(cached)
+    past_key_values.crop(length)
+    return length, past_key_values
+
+
+def store_prefix(recipe_key: str, input_ids: List[int], past_key_values):
+    """Keep the prompt's part of a finished generation's KV cache."""
+    if PREFIX_CACHE.max_bytes <= 0 or len(input_ids) < PREFIX_CACHE.min_tokens:
+        return
+    if past_key_values is None or past_key_values.get_seq_length() < len(input_ids):
+        return
+    PREFIX_CACHE.put(
+        (recipe_key, tuple(input_ids)),
+        compact_kv_cache(past_key_values, len(input_ids)),
+    )
 
 
-def inference(model, prompt, max_new_tokens=512, temperature=0.7):
+def inference(
+    model,
+    prompt,
+    max_new_tokens=512,
+    temperature=0.7,
+    streamer=None,
+    recipe_key=None,
+    stopping_criteria=None,
+):
+    """Generate a completion for one prompt.
+
+    With ``recipe_key`` (the model's recipe hash), prefill starts from the
+    longest prompt prefix already cached for that recipe, and this prompt's
+    prefill is cached for later requests.
+    """
     global DEVICE
 
     do_sample = temperature > 0
@@ -76,202 +313,615 @@ def inference(model, prompt, max_new_tokens=512, temperature=0.7):
     model.eval()
     tokenizer = get_tokenizer()
     inputs = tokenizer(prompt, return_tensors="pt").to(DEVICE)
+    input_ids = inputs["input_ids"][0].tolist()
+
+    reused, past_key_values = 0, None
+    if recipe_key is not None and PREFIX_CACHE.max_bytes > 0:
+        reused, past_key_values = reuse_prefix(recipe_key, input_ids)
+        print(f"WORKER: Reusing {reused}/{len(input_ids)} prompt tokens")
+
     with torch.no_grad():
         outputs = model.generate(
             **inputs,
             max_new_tokens=max_new_tokens,
             do_sample=do_sample,
             temperature=temperature,
-        ).to(DEVICE)
-    return tokenizer.decode(outputs[0], skip_special_tokens=True)
-
-
-def merge_model_recipe(
-    model1_recipe: dict,
-    model2_recipe: dict,
-    layer_recipe: List[List[Tuple[int, int, float]]],
-    embedding_lambdas: List[float] = [0.5, 0.5],
-    linear_lambdas: List[float] = [0.5, 0.5],
-) -> dict:
-    models = [model1_recipe, model2_recipe]
-    result_layer_recipe = []
-    for makeup in layer_recipe:
-        layer_result = {}
-        for comb in makeup:
-            idx, model_i, alpha = comb
-
-            for orig_i, orig_model, orig_a in models[model_i]["layer_recipe"][idx]:
-                if (orig_i, orig_model) in layer_result:
-                    layer_result[(orig_i, orig_model)] += alpha * orig_a
-                else:
-                    layer_result[(orig_i, orig_model)] = alpha * orig_a
-
-        final_layer_result = []
-        for k in layer_result:
-            final_layer_result.append((k[0], k[1], layer_result[k]))
-
-        result_layer_recipe.append(final_layer_result)
-
-    result_embedding_lambdas = [
-        embedding_lambdas[0] * model1_recipe["embedding_lambdas"][0]
-        + (1 - embedding_lambdas[0]) * model2_recipe["embedding_lambdas"][0],
-        embedding_lambdas[1] * model1_recipe["embedding_lambdas"][1]
-        + (1 - embedding_lambdas[1]) * model2_recipe["embedding_lambdas"][1],
-    ]
-    result_linear_lambdas = [
-        linear_lambdas[0] * model1_recipe["linear_lambdas"][0]
-        + (1 - linear_lambdas[0]) * model2_recipe["linear_lambdas"][0],
-        linear_lambdas[1] * model1_recipe["linear_lambdas"][1]
-        + (1 - linear_lambdas[1]) * model2_recipe["linear_lambdas"][1],
-    ]
+            streamer=streamer,
+            past_key_values=past_key_values,
+            return_dict_in_generate=True,
+            stopping_criteria=stopping_criteria,
+        )
+
+    # A prompt that was already cached up to its last token adds nothing new.
+    if recipe_key is not None and reused < len(input_ids) - 1:
+        store_prefix(recipe_key, input_ids, outputs.past_key_values)
+    return tokenizer.decode(outputs.sequences[0], skip_special_tokens=True)
+
+
+class PerRowTemperature(LogitsProcessor):
+    """Applies each row's own temperature; rows with temperature 0 stay greedy."""
+
+    def __init__(self, temperatures: List[float]):
+        self.temperatures = torch.tensor(temperatures)
+
+    def __call__(self, input_ids, scores):
+        temperatures = self.temperatures.to(scores.device, scores.dtype)
+        greedy = (temperatures <= 0).unsqueeze(1)
+        scores = scores / torch.where(greedy, 1.0, temperatures.unsqueeze(1))
+        # Leaving only the argmax makes sampling pick it deterministically.
+        best = scores.argmax(dim=-1, keepdim=True)
+        only_best = torch.full_like(scores, -float("inf")).scatter(
+            1, best, scores.gather(1, best)
+        )
+        return torch.where(greedy, only_best, scores)
+
+
+class PerRowMaxNewTokens(StoppingCriteria):
+    """Stops each row once it has generated its own max_new_tokens."""
+
+    def __init__(self, prompt_length: int, max_new_tokens: List[int]):
+        self.prompt_length = prompt_length
+        self.max_new_tokens = torch.tensor(max_new_tokens)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = input_ids.shape[1] - self.prompt_length
+        return generated >= self.max_new_tokens.to(input_ids.device)
+
+
+class StopWhenCancelled(StoppingCriteria):
+    """Stops generation once the task's cancellation flag is set in Redis,
+    checked every ``every`` tokens."""
+
+    def __init__(self, task_id: str, every: int = CANCEL_CHECK_TOKENS):
+        self.task_id = task_id
+        self.every = max(1, every)
+        self.steps = 0
+        self.cancelled = False
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.steps += 1
+        if not self.cancelled and self.steps % self.every == 0:
+            self.cancelled = is_task_cancelled(self.task_id)
+        return torch.full(
+            (input_ids.shape[0],),
+            self.cancelled,
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
+
+
+class PerRowCancelled(StoppingCriteria):
+    """Stops each row whose own ``StopWhenCancelled`` (or None) has fired."""
+
+    def __init__(self, cancels: List[Optional[StopWhenCancelled]]):
+        self.cancels = cancels
+
+    def __call__(self, input_ids, scores, **kwargs):
+        for cancel in self.cancels:
+            if cancel is not None:
+                cancel(input_ids, scores)
+        return torch.tensor(
+            [cancel is not None and cancel.cancelled for cancel in self.cancels],
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
+
+
+def inference_batch(
+    model,
+    requests: List[Tuple[str, int, float]],
+    cancels: Optional[List[Optional[StopWhenCancelled]]] = None,
+) -> List[str]:
+    """Generate for several (prompt, max_new_tokens, temperature) requests at once.
+
+    ``cancels`` holds each row's cancellation check, if any; a cancelled row
+    stops while the others go on.
+    """
+    prompts = [prompt for prompt, _, _ in requests]
+    max_new_tokens = [n for _, n, _ in requests]
+    temperatures = [t for _, _, t in requests]
+
+    model = model.to(DEVICE)
+    model.eval()
+    tokenizer = get_tokenizer()
+    inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(DEVICE)
+    criteria = [PerRowMaxNewTokens(inputs["input_ids"].shape[1], max_new_tokens)]
+    if cancels is not None and any(cancels):
+        criteria.append(PerRowCancelled(cancels))
+    with torch.no_grad():
+        outputs = model.generate(
+            **inputs,
+            max_new_tokens=max(max_new_tokens),
+            do_sample=any(t > 0 for t in temperatures),
+            logits_processor=LogitsProcessorList([PerRowTemperature(temperatures)]),
+            stopping_criteria=StoppingCriteriaList(criteria),
+            pad_token_id=tokenizer.pad_token_id,
+        )
+    return tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+
+def run_inference_batch(key, items):
+    """Run (model, prompt, max_new_tokens, temperature, cancel) items for one
+    recipe."""
+    model = items[0][0]
+    if len(items) == 1:
+        # A lone request gains nothing from padding, but can reuse a prefix.
+        _, prompt, max_new_tokens, temperature, cancel = items[0]
+        return [
+            inference(
+                model,
+                prompt,
+                max_new_tokens,
+                temperature,
+                recipe_key=key,
+                stopping_criteria=StoppingCriteriaList([cancel]) if cancel else None,
+            )
+        ]
+    print(f"WORKER: Running inference batch of {len(items)}")
+    return inference_batch(
+        model, [item[1:4] for item in items], [item[4] for item in items]
+    )
+
+
+BATCH_SCHEDULER = (
+    BatchScheduler(
+        run_inference_batch,
+        INFERENCE_BATCH_WINDOW_MS / 1000,
+        INFERENCE_MAX_BATCH_SIZE,
+    )
+    if INFERENCE_BATCH_WINDOW_MS > 0
+    else None
+)
+
+
+def blend(lam: float, tensor1: torch.Tensor, tensor2: torch.Tensor) -> torch.Tensor:
+    if lam == 1.0:
+        return tensor1
+    if lam == 0.0:
+        return tensor2
+    # Accumulate in fp32 and round once when the weights are stored in lower
+    # precision.
+    blended = lam * tensor1.float() + (1 - lam) * tensor2.float()
+    return blended.to(tensor1.dtype)
+
+
+def parent_state_dicts():
+    return (BASE_MODELS["svamp"].state_dict(), BASE_MODELS["tinystories"].state_dict())
+
+
+def child_config(model_recipe: dict, base_model="gpt2-medium"):
+    config = copy.deepcopy(get_base_config(base_model))
+    config.n_layer = len(model_recipe["layer_recipe"])
+    return config
 
-    return {
-        "layer_recipe": result_layer_recipe,
-        "embedding_lambdas": result_embedding_lambdas,
-        "linear_lambdas": result_linear_lambdas,
+
+def non_block_parts(model_recipe: dict, config) -> Dict[str, Tuple[List[str], float]]:
+    """Each non-block part of a child (see ``recipe_parts``) as its state dict
+    keys and the lambda that blends the parents into them.
+
+    With tied embeddings wte is not a part of its own: it is the lm_head
+    parameter, and the lm_head blend is the one that has always ended up in it.
+    """
+    embedding_lambdas = model_recipe["embedding_lambdas"]
+    linear_lambdas = model_recipe["linear_lambdas"]
+    parts = {
+        "wpe": (["transformer.wpe.weight"], embedding_lambdas[1]),
+        "lm_head": (["lm_head.weight"], linear_lambdas[0]),
+        "ln_f": (
+            ["transformer.ln_f.weight", "transformer.ln_f.bias"],
+            linear_lambdas[1],
+        ),
     }
+    if not config.tie_word_embeddings:
+        parts["wte"] = (["transformer.wte.weight"], embedding_lambdas[0])
+    return parts
 
 
 def merge_models(
     model_recipe: dict,
     base_model="gpt2-medium",
+    reuse: Optional[Tuple[nn.Module, Set[str]]] = None,
 ) -> nn.Module:
-    """Merge two models based on a given recipe."""
-
-    model1_name = "svamp"
-    model2_name = "tinystories"
+    """Merge two models based on a given recipe.
 
-    def get_model_layer(layer, model):
-        return model.transformer.h[layer].state_dict()
+    Blocks come from ``BLOCK_CACHE``, so children share every block whose layer
+    recipe they have in common and only new ones are merged. ``reuse`` is an
+    existing child and the parts (see ``recipe_parts``) in which its recipe
+    differs from ``model_recipe``; its embeddings, lm_head and final norm are
+    taken as-is where unchanged.
+    """
 
-    def merge_layer(recipe: List[Tuple[int, str, float]]):
-        base = get_model_layer(recipe[0][0], BASE_MODELS[recipe[0][1]])
-        for key in base.keys():
-            base[key] = recipe[0][2] * base[key]
-        for layer in recipe[1:]:
-            layer_data = get_model_layer(layer[0], BASE_MODELS[layer[1]])
-            for key in base.keys():
-                base[key] += layer[2] * layer_data[key]
-        return base
+    if reuse is None:
+        reused, changed = {}, set(recipe_parts(model_recipe))
+    else:
+        reused, changed = reuse[0].state_dict(), reuse[1]
 
-    print("### Merging models... ###")
+    print(f"### Merging models ({len(changed)} parts)... ###")
 
     layer_recipe = model_recipe["layer_recipe"]
-    embedding_lambdas = model_recipe["embedding_lambdas"]
-    linear_lambdas = model_recipe["linear_lambdas"]
-
-    config = AutoConfig.from_pretrained(base_model)
-    config.n_layer = len(layer_recipe)
+    config = child_config(model_recipe, base_model)
 
-    child_model = AutoModelForCausalLM.from_config(config).to(DEVICE)
+    # Build the skeleton without allocating or initializing weights; every
+    # parameter is assigned from the merged state dict below.
+    with init_empty_weights():
+        child_model = AutoModelForCausalLM.from_config(config)
     child_model.eval()
 
-    print("Merging embeddings and lm_head...")
-    child_model.transformer.wte.weight.data = (
-        embedding_lambdas[0] * BASE_MODELS[model1_name].transformer.wte.weight.data
-        + (1 - embedding_lambdas[0])
-        * BASE_MODELS[model2_name].transformer.wte.weight.data
-    )
-    child_model.transformer.wpe.weight.data = (
-        embedding_lambdas[1] * BASE_MODELS[model1_name].transformer.wpe.weight.data
-        + (1 - embedding_lambdas[1])
-        * BASE_MODELS[model2_name].transformer.wpe.weight.data
-    )
-    child_model.lm_head.weight.data = (
-        linear_lambdas[0] * BASE_MODELS[model1_name].lm_head.weight.data
-        + (1 - linear_lambdas[0]) * BASE_MODELS[model2_name].lm_head.weight.data
-    )
-    child_model.transformer.ln_f.weight.data = (
-        linear_lambdas[1] * BASE_MODELS[model1_name].transformer.ln_f.weight.data
-        + (1 - linear_lambdas[1])
-        * BASE_MODELS[model2_name].transformer.ln_f.weight.data
-    )
-    child_model.transformer.ln_f.bias.data = (
-        linear_lambdas[1] * BASE_MODELS[model1_name].transformer.ln_f.bias.data
-        + (1 - linear_lambdas[1]) * BASE_MODELS[model2_name].transformer.ln_f.bias.data
-    )
+    parents = parent_state_dicts()
+    state_dict = {}
 
-    for i, layer in tqdm(enumerate(layer_recipe), desc="Merging layers..."):
-        merged_layer = merge_layer(layer)
-        child_model.transformer.h[i].load_state_dict(merged_layer)
+    print("Merging embeddings and lm_head...")
+    for name, (keys, lam) in non_block_parts(model_recipe, config).items():
+        for key in keys:
+            if name in changed:
+                state_dict[key] = blend(lam, parents[0][key], parents[1][key])
+            else:
+                state_dict[key] = reused[key]
+    if config.tie_word_embeddings:
+        state_dict["transformer.wte.weight"] = state_dict["lm_head.weight"]
+
+    print("Merging layers...")
+    block_keys = []
+    for i, terms in enumerate(layer_recipe):
+        if LAYER_STACK.is_view(terms):
+            idx, name, _ = terms[0]
+            flat = LAYER_STACK.layer(name, idx)
+        else:
+            terms = canonicalize_layer(terms)
+            key = tuple(map(tuple, terms))
+            flat = BLOCK_CACHE.acquire(
+                key, lambda: LAYER_STACK.merge_layers([terms])[0]
+            )
+            block_keys.append(key)
+        for key, tensor in LAYER_STACK.layer_state_dict(flat).items():
+            state_dict[f"transformer.h.{i}.{key}"] = tensor
+
+    # assign=True keeps the merged (or aliased) tensors instead of copying them.
+    child_model.load_state_dict(state_dict, assign=True)
+    child_model.tie_weights()
+    child_model.to(DEVICE)
+
+    # Children may share storage with BASE_MODELS and with each other, so they
+    # must never be trained or modified in place.
+    child_model.requires_grad_(False)
+    child_model.merge_recipe = model_recipe
+    weakref.finalize(child_model, BLOCK_CACHE.release, block_keys)
 
     return child_model
 
 
-def get_model_recipe_default(session_id: str, model_name: str) -> dict:
-    if model_name in BASE_MODELS_NAMES:
-        return get_model_recipe("default", model_name)
-    return get_model_recipe(session_id, model_name)
+WORKER_NAME = f"{socket.gethostname()}:{os.getpid()}"
+READY_HEARTBEAT = threading.Event()
+MERGE_LOCK = threading.Lock()
 
 
-@celery_app.task(name="tasks.inference")
-def inference_task(
-    session_id: str, model_name, prompt, max_new_tokens=512, temperature=0.7
-):
-    try:
-        load_base_models_if_needed()
+def runs_tasks_in_threads(worker) -> bool:
+    """Whether ``worker`` runs several tasks at once in its own process.
 
-        model_recipe = get_model_recipe_default(session_id, model_name)
-        print("WORKER: Creating merged model...")
-        model = merge_models(model_recipe)
-        print("WORKER: Model loaded.")
-        output = inference(model, prompt, max_new_tokens, temperature)
-        return {"response": output}
-    except Exception as e:
-        raise InvalidTaskError(f"Inference failed: {e}")
+    Only then can concurrent requests meet in ``BATCH_SCHEDULER``; a prefork
+    child runs one task at a time, so each request would just wait out the
+    window alone.
+    """
+    pool = getattr(worker, "pool_cls", None) or celery_app.conf.worker_pool
+    if not isinstance(pool, str):
+        pool = f"{pool.__module__}.{pool.__qualname__}"
+    concurrency = getattr(worker, "concurrency", None) or 1
+    return "thread" in pool.lower() and concurrency > 1
 
 
-@celery_app.task(name="tasks.merge_models")
-def merge_models_task(
-    session_id: str,
-    model1_name: str,
-    model2_name: str,
-    layer_recipe: List[List[Tuple[int, int, float]]],
-    embedding_lambdas: List[float] = [0.5, 0.5],
-    linear_lambdas: List[float] = [0.5, 0.5],
-    merged_name: str = "merged",
-):
-    if len(layer_recipe) > 48:
-        raise InvalidTaskError("Layer recipe too long. Max 48 layers supported.")
+@worker_init.connect
+def warm_up_worker(sender=None, **kwargs):
+    """Load models and tokenizer in the parent before the pool forks.
 
+    Prefork children inherit the warm state, so no task pays the load, and the
+    worker does not consume from the queue until this returns.
+    """
+    global BATCH_SCHEDULER
+    if BATCH_SCHEDULER is not None and not runs_tasks_in_threads(sender):
+        print(
+            "WORKER: INFERENCE_BATCH_WINDOW_MS needs a thread pool running "
+            "several tasks (-P threads -c N); batching disabled."
+        )
+        BATCH_SCHEDULER = None
     load_base_models_if_needed()
+    get_tokenizer()
+
+
+def _ready_heartbeat():
+    while not READY_HEARTBEAT.wait(READY_TTL_SECONDS / 3):
+        mark_worker_ready(WORKER_NAME, READY_TTL_SECONDS)
+
+
+@worker_ready.connect
+def announce_worker_ready(**kwargs):
+    mark_worker_ready(WORKER_NAME, READY_TTL_SECONDS)
+    threading.Thread(target=_ready_heartbeat, daemon=True).start()
+    print(f"WORKER: {WORKER_NAME} ready.")
+
+
+@worker_shutdown.connect
+def withdraw_worker_ready(**kwargs):
+    READY_HEARTBEAT.set()
+    clear_worker_ready(WORKER_NAME)
+
+
+def nearest_cached_child(model_recipe: dict):
+    """The cached child whose recipe differs from ``model_recipe`` in the fewest
+    parts, with those parts, or None if no cached child shares any part."""
+    nearest = None
+    for key, model in MODEL_CACHE.items():
+        recipe = getattr(model, "merge_recipe", None)
+        # int8 and fp32 copies carry their source's recipe but hold converted
+        # blocks.
+        if recipe is None or ":" in key:
+            continue
+        changed = changed_parts(recipe, model_recipe)
+        if nearest is None or len(changed) < len(nearest[1]):
+            nearest = (model, changed)
+    if nearest is None or len(nearest[1]) == len(recipe_parts(model_recipe)):
+        return None
+    return nearest
+
+
+def base_store_key() -> str:
+    """Short digest of what merged weights depend on besides their recipe: the
+    parents, their dtype, the base store format and the base store export."""
+    base = json.dumps(
+        [BASE_MODELS_NAMES, str(WEIGHT_DTYPE), base_store_spec(), BASE_STORE_ID]
+    )
+    return hashlib.sha256(base.encode("utf-8")).hexdigest()[:16]
+
+
+def merged_cache_key(key: str) -> str:
+    """Name of recipe hash ``key`` in ``MERGED_CACHE``; a stored child only
+    matches the base store it was merged from."""
+    return f"{key}.{base_store_key()}"
+
+
+def load_merged_model(key: str) -> Optional[nn.Module]:
+    """The child for recipe hash ``key`` mapped from ``MERGED_CACHE``, or None.
+
+    Its merged blocks go through ``BLOCK_CACHE`` like freshly merged ones, so
+    they are shared with other children and reused by later merges.
+    """
+    path = MERGED_CACHE.get(merged_cache_key(key))
+    if path is None:
+        return None
+    print(f"WORKER: Loading merged model from {path}...")
+    block_keys = []
+
+    def block(terms, flat):
+        block_key = tuple(map(tuple, canonicalize_layer(terms)))
+        block_keys.append(block_key)
+        return BLOCK_CACHE.acquire(block_key, lambda: flat)
+
+    model = load_child_store(path, LAYER_STACK, DEVICE, block=block)
+    weakref.finalize(model, BLOCK_CACHE.release, block_keys)
+    return model
+
+
+def save_merged_model(key: str, model: nn.Module) -> None:
+    """Write a new child to ``MERGED_CACHE`` in the background, so the request
+    that merged it does not wait for the disk."""
+    if MERGED_CACHE.max_bytes <= 0:
+        return
+
+    def save():
+        try:
+            MERGED_CACHE.put(
+                merged_cache_key(key),
+                lambda path: save_child_store(
+                    path, model, LAYER_STACK, model.merge_recipe
+                ),
+            )
+            print(f"WORKER: Merged cache {MERGED_CACHE.stats()}")
+        except OSError as e:
+            print(f"WORKER: Could not save merged model: {e}")
+
+    threading.Thread(target=save, daemon=True).start()
+
+
+def get_merged_model(model_recipe: dict) -> nn.Module:
+    """Return the child model for a recipe, merging only on a cache miss.
+
+    A miss first looks for the child in ``MERGED_CACHE`` on disk, which survives
+    worker restarts. Otherwise it starts from the nearest cached child and
+    merges only the parts its recipe changes, so small edits re-merge in
+    proportion to their size.
+    """
+    model_recipe = canonicalize_recipe(model_recipe)
+    key = recipe_hash(model_recipe)
+    model = MODEL_CACHE.get(key)
+    if model is None:
+        # With a thread pool, concurrent requests for one recipe merge it once.
+        with MERGE_LOCK:
+            model = MODEL_CACHE.get(key)
+            if model is None:
+                model = load_merged_model(key)
+                if model is None:
+                    print("WORKER: Creating merged model...")
+                    model = merge_models(
+                        model_recipe, reuse=nearest_cached_child(model_recipe)
+                    )
+                    save_merged_model(key, model)
+                MODEL_CACHE.put(key, model)
+    print(f"WORKER: Model cache {MODEL_CACHE.stats()}")
+    print(f"WORKER: Block cache {BLOCK_CACHE.stats()}")
+    return model
+
+
+def get_serving_model(model_recipe: dict) -> nn.Module:
+    """The model inference runs on: the merged child, or a copy of it cached
+    next to the child under its own key. With INFERENCE_INT8 the copy is
+    quantized to int8; on CPUs without native bf16 (``SERVE_FP32``) a bf16
+    child is upcast to fp32."""
+    if INFERENCE_INT8:
+        kind, convert = "int8", quantize_model
+    elif SERVE_FP32:
+        kind, convert = "fp32", upcast_model
+    else:
+        return get_merged_model(model_recipe)
+    key = f"{recipe_hash(model_recipe)}:{kind}"
+    model = MODEL_CACHE.get(key)
+    if model is None:
+        merged = get_merged_model(model_recipe)
+        with MERGE_LOCK:
+            model = MODEL_CACHE.get(key)
+            if model is None:
+                print(f"WORKER: Converting merged model to {kind}...")
+                model = convert(merged)
+                MODEL_CACHE.put(key, model)
+    return model
+
+
+def export_merged_model(
+    model_recipe: dict, path: str, base_model="gpt2-medium"
+) -> None:
+    """Write a recipe's child to the directory ``path`` for ``from_pretrained``.
+
+    The child is never built: each tensor is merged just before it is written
+    to ``model.safetensors`` and dropped after, so memory peaks at about one
+    block (or embedding) above the base models instead of a whole extra model.
+    """
+    model_recipe = canonicalize_recipe(model_recipe)
+    config = child_config(model_recipe, base_model)
+    parents = parent_state_dicts()
+    parts = non_block_parts(model_recipe, config)
+
+    def saved_key(key):
+        # Like save_pretrained, store a tied lm_head once, as wte;
+        # from_pretrained ties it back.
+        if config.tie_word_embeddings and key == "lm_head.weight":
+            return "transformer.wte.weight"
+        return key
+
+    specs = [
+        (saved_key(key), parents[0][key].dtype, parents[0][key].shape)
+        for keys, _ in parts.values()
+        for key in keys
+    ]
+    for i in range(config.n_layer):
+        for key, _, _, shape in LAYER_STACK.layout:
+            specs.append((f"transformer.h.{i}.{key}", LAYER_STACK.buffer.dtype, shape))
+
+    def tensors():
+        for keys, lam in parts.values():
+            for key in keys:
+                yield blend(lam, parents[0][key], parents[1][key])
+        for terms in model_recipe["layer_recipe"]:
+            flat = LAYER_STACK.merge_layers([terms])[0]
+            yield from LAYER_STACK.layer_state_dict(flat).values()
+
+    os.makedirs(path, exist_ok=True)
+    config.torch_dtype = LAYER_STACK.buffer.dtype
+    config.save_pretrained(path)
+    save_file_streaming(
+        os.path.join(path, "model.safetensors"),
+        specs,
+        tensors(),
+        metadata={
+            "format": "pt",
+            "recipe": json.dumps(model_recipe),
+            "base": base_store_key(),
+        },
+    )
 
-    session_models = get_session_models(session_id)
 
-    model1_recipe = get_model_recipe_default(session_id, model1_name)
-    model2_recipe = get_model_recipe_default(session_id, model2_name)
-    if model1_recipe is None or model2_recipe is None:
-        raise InvalidTaskError("One of the models does not exist.")
+@celery_app.task(name="tasks.export")
+def export_task(session_id: str, model_name):
+    """Export a session model under ``EXPORT_DIR/<recipe hash>``, once per recipe
+    and base store: an export merged from another base store is replaced."""
+    try:
+        load_base_models_if_needed()
 
-    merged_recipe = merge_model_recipe(
-        model1_recipe,
-        model2_recipe,
-        layer_recipe,
-        embedding_lambdas,
-        linear_lambdas,
+        model_recipe = get_model_recipe_default(session_id, model_name)
+        if model_recipe is None:
+            raise ValueError(f"Model {model_name} does not exist.")
+        key = recipe_hash(model_recipe)
+        path = os.path.join(EXPORT_DIR, key)
+        with file_lock(path):
+            metadata = read_metadata(os.path.join(path, "model.safetensors"))
+            if metadata is None or metadata.get("base") != base_store_key():
+                print(f"WORKER: Exporting merged model to {path}...")
+                export_merged_model(model_recipe, path)
+        return {"response": {"recipe_hash": key, "path": path}}
+    except Exception as e:
+        raise InvalidTaskError(f"Export failed: {e}")
+
+
+def revoke_cancelled(task, stream: bool):
+    """End a task whose client cancelled it, recording it as revoked."""
+    print(f"WORKER: Task {task.request.id} cancelled.")
+    if stream:
+        publish_stream_event(
+            task.request.id, "error", {"detail": "Generation cancelled."}
+        )
+    task.update_state(
+        state=states.REVOKED, meta=TaskRevokedError("Generation cancelled.")
     )
+    raise Ignore()
 
-    for i in range(20):
-        full_merged_name = f"{merged_name}_{i}"
-        if full_merged_name not in session_models:
-            add_model_to_session(session_id, full_merged_name)
-            save_model_recipe(session_id, full_merged_name, merged_recipe)
-            return {"response": full_merged_name}
 
-    raise InvalidTaskError("Could not find a unique model name.")
-
-
-@celery_app.task(name="tasks.get_all_models")
-def get_all_models_task(session_id: str) -> List[str]:
-    load_base_models_if_needed()
-
-    base_models = BASE_MODELS_NAMES
-    session_models = get_session_models(session_id)
-    all_models = list(set(base_models + session_models))
-    return {"response": all_models}
+@celery_app.task(name="tasks.inference", bind=True)
+def inference_task(
+    self,
+    session_id: str,
+    model_name,
+    prompt,
+    max_new_tokens=512,
+    temperature=0.7,
+    stream=False,
+):
+    task_id = self.request.id
+    stream = stream and task_id is not None
+    try:
+        if task_id is not None and is_task_cancelled(task_id):
+            revoke_cancelled(self, stream)
 
+        load_base_models_if_needed()
 
-@celery_app.task(name="tasks.clear_session_models")
-def clear_session_models_task(session_id: str) -> str:
-    delete_session(session_id)
-    return {"response": ""}
+        model_recipe = get_model_recipe_default(session_id, model_name)
+        model = get_serving_model(model_recipe)
+        key = recipe_hash(model_recipe)
+        print("WORKER: Model loaded.")
+        cancel = StopWhenCancelled(task_id) if task_id is not None else None
+        stopping_criteria = StoppingCriteriaList([cancel]) if cancel else None
+        if stream:
+            streamer = RedisStreamer(get_tokenizer(), task_id)
+            output = inference(
+                model,
+                prompt,
+                max_new_tokens,
+                temperature,
+                streamer,
+                recipe_key=key,
+                stopping_criteria=stopping_criteria,
+            )
+        elif BATCH_SCHEDULER is not None:
+            output = BATCH_SCHEDULER.submit(
+                key, (model, prompt, max_new_tokens, temperature, cancel)
+            ).result()
+        else:
+            output = inference(
+                model,
+                prompt,
+                max_new_tokens,
+                temperature,
+                recipe_key=key,
+                stopping_criteria=stopping_criteria,
+            )
+        if cancel is not None and cancel.cancelled:
+            revoke_cancelled(self, stream)
+        if stream:
+            publish_stream_event(task_id, "done", {"response": output})
+        return {"response": output}
+    except Ignore:
+        raise
+    except Exception as e:
+        if stream:
+            publish_stream_event(task_id, "error", {"detail": f"Inference failed: {e}"})
+        raise InvalidTaskError(f"Inference failed: {e}")
+    finally:
+        if task_id is not None:
+            # Frees the admission slots the API took for this task.
+            release_task(task_id, session_id)
@@ -17,7 +17,7 @@ function App() {
   const [numLayers, setNumLayers] = useState(12);
   const [isSpaceLoading, setIsSpaceLoading] = useState(true);
 
-  const { fetchModels, checkTaskStatus } = useAPI();
+  const { fetchModels } = useAPI();
 
   useEffect(() => {
     setModelLayers("svamp", 24);
@@ -25,25 +25,11 @@ function App() {
 
     const loadModels = async () => {
       try {
-        const taskId = await fetchModels();
-
-        if (taskId) {
-          checkTaskStatus(
-            taskId,
-            (result) => {
-              if (result && Array.isArray(result.response)) {
-                setModels(result.response);
-                setIsSpaceLoading(false);
-              }
-            },
-            (error) => {
-              devError("Failed to load models:", error);
-              setIsSpaceLoading(false); // Set to false even on error
-            }
-          );
-        } else {
-          setIsSpaceLoading(false);
+        const result = await fetchModels();
+        if (result && Array.isArray(result.response)) {
+          setModels(result.response);
         }
+        setIsSpaceLoading(false);
       } catch (error) {
         devError("Error fetching models:", error);
         setIsSpaceLoading(false); // Set to false even on error
@@ -51,7 +37,7 @@ function App() {
     };
 
     loadModels();
-  }, [fetchModels, checkTaskStatus]);
+  }, [fetchModels]);
 
   return (
     <div className="h-screen bg-secondary-50 overflow-hidden">
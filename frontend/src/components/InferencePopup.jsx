@@ -1,4 +1,4 @@
-import { useState } from "react";
+import { useRef, useState } from "react";
 import Dropdown from "./Dropdown";
 import NumberInput from "./NumberInput";
 import { useAPI } from "../hooks/useAPI";
@@ -13,7 +13,9 @@ const InferencePopup = ({ isOpen, onClose, models }) => {
   const [maxNewTokens, setMaxNewTokens] = useState(512);
   const [temperature, setTemperature] = useState(0.7);
 
-  const { inference, checkTaskStatus } = useAPI();
+  const abortController = useRef(null);
+
+  const { inferenceStream } = useAPI();
 
   const handleInference = async () => {
     if (!selectedModel || !prompt.trim()) {
@@ -23,7 +25,7 @@ const InferencePopup = ({ isOpen, onClose, models }) => {
 
     setIsLoading(true);
     setError("");
-    setResponse("");
+    setResponse(prompt);
 
     try {
       const inferenceData = {
@@ -34,48 +36,33 @@ const InferencePopup = ({ isOpen, onClose, models }) => {
       };
 
       devLog("Starting inference with data:", inferenceData);
-      const result = await inference(inferenceData);
+      abortController.current = new AbortController();
+      const result = await inferenceStream(
+        inferenceData,
+        (text) => setResponse((current) => current + text),
+        abortController.current.signal
+      );
       devLog("Got inference result:", result);
 
-      if (result && result.task_id) {
-        checkTaskStatus(
-          result.task_id,
-          (taskResult) => {
-            devLog("Inference task result:", taskResult);
-            if (taskResult && taskResult.response) {
-              setResponse(taskResult.response);
-            } else if (taskResult && taskResult.error) {
-              setError(`Inference failed: ${taskResult.error}`);
-            } else {
-              setError("No response received from the model");
-            }
-            setIsLoading(false);
-          },
-          (errorMessage) => {
-            // Error callback for task status check
-            devError("Inference task failed:", errorMessage);
-            setError(`Task failed: ${errorMessage}`);
-            setIsLoading(false);
-          }
-        );
-      } else if (result && result.error) {
-        // Check if it's a server error
-        const isServerError = result.error.includes("HTTP 5");
-        const errorPrefix = isServerError ? "🔴 Server Error: " : "Error: ";
-        setError(`${errorPrefix}${result.error}`);
-        setIsLoading(false);
+      if (result && result.response) {
+        setResponse(result.response);
       } else {
-        setError("No task ID received");
-        setIsLoading(false);
+        setError("No response received from the model");
       }
     } catch (err) {
+      if (err.name === "AbortError") return;
       devError("Inference error:", err);
-      setError(`Error: ${err.message}`);
+      const isServerError = err.message.includes("HTTP 5");
+      const errorPrefix = isServerError ? "🔴 Server Error: " : "Error: ";
+      setError(`${errorPrefix}${err.message}`);
+    } finally {
       setIsLoading(false);
     }
   };
 
   const handleClose = () => {
+    // Closing stops the generation instead of leaving it running on the worker.
+    abortController.current?.abort();
     setSelectedModel("");
     setPrompt("");
     setResponse("");
@@ -25,7 +25,7 @@ const Options = ({
   const [isLoading, setIsLoading] = useState(false);
   const [mergeStatus, setMergeStatus] = useState("");
   const [isInferenceOpen, setIsInferenceOpen] = useState(false);
-  const { mergeModels, checkTaskStatus } = useAPI();
+  const { mergeModels } = useAPI();
 
   const handleMerge = async () => {
     if (
@@ -63,33 +63,14 @@ const Options = ({
       };
 
       devLog("Starting merge with data:", mergeData);
-      const taskId = await mergeModels(mergeData);
-      devLog("Got merge task ID:", taskId);
+      const result = await mergeModels(mergeData);
+      devLog("Merge result:", result);
 
-      if (taskId) {
-        checkTaskStatus(
-          taskId,
-          (taskResult) => {
-            devLog("Merge result:", taskResult);
-            if (taskResult.response) {
-              setMergeStatus("Merge successful!");
-              const newModelName = taskResult.response || mergedName;
-              setModels((prev) => [...prev, newModelName]);
-              setModelLayers(newModelName, numLayers);
-            } else {
-              setMergeStatus(
-                `Merge failed: ${taskResult.error || "Unknown error"}`
-              );
-            }
-            setIsLoading(false);
-          },
-          (error) => {
-            devError("Merge task failed:", error);
-            setMergeStatus(`Merge failed: ${error}`);
-            setIsLoading(false);
-          }
-        );
-      }
+      setMergeStatus("Merge successful!");
+      const newModelName = result.response || mergedName;
+      setModels((prev) => [...prev, newModelName]);
+      setModelLayers(newModelName, numLayers);
+      setIsLoading(false);
     } catch (error) {
       devError("Merge error:", error);
       setMergeStatus(`Error: ${error.message}`);
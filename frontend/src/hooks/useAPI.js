@@ -3,11 +3,22 @@ import { devLog, devError } from "../utils/devLogger";
 
 const API_BASE = "https://tcmmichaelb139-evolutiontransformer.hf.space";
 
+// A busy server answers generation requests with 429 and a Retry-After.
+const generateError = async (response) => {
+  const body = await response.json().catch(() => ({}));
+  const error =
+    body.detail || `HTTP ${response.status}: ${response.statusText}`;
+  const retryAfter = response.headers.get("Retry-After");
+  return retryAfter ? `${error} Retry in ${retryAfter}s.` : error;
+};
+
 export const useAPI = () => {
   const checkTaskStatus = useCallback(
     async (taskId, successCallback, errorCallback) => {
       try {
-        const response = await fetch(`${API_BASE}/tasks/${taskId}`, {
+        // Long-poll: the server holds the request until the task finishes or
+        // the wait runs out, so there is no need to sleep between checks.
+        const response = await fetch(`${API_BASE}/tasks/${taskId}?wait=25`, {
           credentials: "include",
         });
 
@@ -23,15 +34,19 @@ export const useAPI = () => {
 
         if (data.status === "SUCCESS") {
           successCallback(data.result);
-        } else if (data.status === "PENDING") {
-          setTimeout(
-            () => checkTaskStatus(taskId, successCallback, errorCallback),
-            1000
-          );
+        } else if (data.status === "PENDING" || data.status === "STARTED") {
+          checkTaskStatus(taskId, successCallback, errorCallback);
         } else if (data.status === "FAILURE") {
           const error = data.result || "Task failed";
           devError("Task failed:", error);
           if (errorCallback) errorCallback(error);
+        } else if (data.status === "REVOKED") {
+          devLog("Task cancelled:", taskId);
+          if (errorCallback) errorCallback("Generation cancelled");
+        } else {
+          const error = `Unexpected task status: ${data.status}`;
+          devError("Task check failed:", error);
+          if (errorCallback) errorCallback(error);
         }
       } catch (error) {
         devError("Task check error:", error);
@@ -58,7 +73,7 @@ export const useAPI = () => {
 
       const data = await response.json();
       devLog("Fetch models response:", data);
-      return data.task_id;
+      return data;
     } catch (error) {
       devError("Fetch models error:", error);
       throw error;
@@ -76,14 +91,16 @@ export const useAPI = () => {
       });
 
       if (!response.ok) {
-        const error = `HTTP ${response.status}: ${response.statusText}`;
+        const body = await response.json().catch(() => ({}));
+        const error =
+          body.detail || `HTTP ${response.status}: ${response.statusText}`;
         devError("Merge failed:", error);
         throw new Error(error);
       }
 
       const data = await response.json();
       devLog("Merge response:", data);
-      return data.task_id;
+      return data;
     } catch (error) {
       devError("Merge error:", error);
       throw error;
@@ -101,7 +118,7 @@ export const useAPI = () => {
       });
 
       if (!response.ok) {
-        const error = `HTTP ${response.status}: ${response.statusText}`;
+        const error = await generateError(response);
         devError("Inference failed:", error);
         throw new Error(error);
       }
@@ -115,10 +132,64 @@ export const useAPI = () => {
     }
   }, []);
 
+  // Aborting with `signal` closes the stream, which cancels the generation.
+  const inferenceStream = useCallback(async (inferenceData, onToken, signal) => {
+    devLog("Streaming inference with data:", inferenceData);
+    const response = await fetch(`${API_BASE}/generate_stream`, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify(inferenceData),
+      credentials: "include",
+      signal,
+    });
+
+    if (!response.ok) {
+      const error = await generateError(response);
+      devError("Streaming inference failed:", error);
+      throw new Error(error);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      let boundary;
+      while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+        const rawEvent = buffer.slice(0, boundary);
+        buffer = buffer.slice(boundary + 2);
+
+        let event = "message";
+        let data = "";
+        for (const line of rawEvent.split("\n")) {
+          if (line.startsWith("event: ")) event = line.slice(7);
+          else if (line.startsWith("data: ")) data += line.slice(6);
+        }
+        const payload = data ? JSON.parse(data) : {};
+
+        if (event === "token") {
+          onToken(payload.text);
+        } else if (event === "done") {
+          return payload;
+        } else if (event === "error") {
+          devError("Streaming inference error:", payload.detail);
+          throw new Error(payload.detail);
+        }
+      }
+    }
+
+    throw new Error("Stream ended before inference finished");
+  }, []);
+
   return {
     checkTaskStatus,
     fetchModels,
     mergeModels,
     inference,
+    inferenceStream,
   };
 };
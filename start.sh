@@ -2,6 +2,15 @@
 
 set -e
 
-uv run celery -A evolutiontransformer.worker.celery_app worker --loglevel=info -c 2 &
+if [ "${WORKER_POOL:-prefork}" = "threads" ]; then
+    # One process runs several tasks at once, so INFERENCE_BATCH_WINDOW_MS can
+    # batch them; split the cores between the tasks.
+    WORKER_CONCURRENCY=${WORKER_CONCURRENCY:-4}
+    OMP_NUM_THREADS=${OMP_NUM_THREADS:-$(( $(nproc) / WORKER_CONCURRENCY ))}
+    export OMP_NUM_THREADS=$(( OMP_NUM_THREADS > 0 ? OMP_NUM_THREADS : 1 ))
+    uv run celery -A evolutiontransformer.worker.celery_app worker --loglevel=info -P threads -c "$WORKER_CONCURRENCY" &
+else
+    uv run celery -A evolutiontransformer.worker.celery_app worker --loglevel=info -c 2 &
+fi
 
 uv run gunicorn evolutiontransformer.api:app -w 4 -k uvicorn.workers.UvicornWorker -b 0.0.0.0:7860
\ No newline at end of file
@@ -1,9 +1,23 @@
+import asyncio
 import pytest
 from fastapi.testclient import TestClient
+from kombu import Connection
+from kombu.serialization import dumps
+import json
 import time
 import re
+import uuid
 
-from evolutiontransformer.api import app
+from evolutiontransformer import api
+from evolutiontransformer.api import RESPONSE_CACHE_TTL_SECONDS, app
+from evolutiontransformer.recipes import base_model_recipe, recipe_hash
+from evolutiontransformer.redis import (
+    get_model_recipe,
+    recipe_key,
+    redis_client,
+    response_key,
+    session_key,
+)
 
 
 def get_final_answer(text: str) -> int | None:
@@ -20,7 +34,9 @@ def client():
 def await_task_completion(client, task_id, timeout=60):
     start_time = time.time()
     while time.time() - start_time < timeout:
-        status_response = client.get(f"/tasks/{task_id}")
+        status_response = client.get(
+            f"/tasks/{task_id}", params={"wait": min(30, timeout)}
+        )
 
         print(status_response.json())
 
@@ -31,8 +47,6 @@ def await_task_completion(client, task_id, timeout=60):
 
         if status_data["status"] == "SUCCESS":
             return status_data["result"]
-
-        time.sleep(2)
     else:
         pytest.fail(
             f"Task {task_id} did not complete within the {timeout}-second timeout."
@@ -41,6 +55,47 @@ def await_task_completion(client, task_id, timeout=60):
     return None
 
 
+def test_send_task_publishes_what_kombu_would(monkeypatch):
+    """
+    Tests that a task published on the async client is the message kombu sends
+    """
+    pushed = []
+
+    class Recorder:
+        async def lpush(self, queue, payload):
+            pushed.append((queue, json.loads(payload)))
+
+    monkeypatch.setattr(api, "async_redis_client", Recorder())
+    args = ["session", "svamp", "Answer:", 2, 0.0, False]
+    asyncio.run(api.send_task("tasks.inference", args, "task-id", "priority"))
+    queue, envelope = pushed[0]
+
+    message = api.celery_app.amqp.as_task_v2(
+        "task-id", "tasks.inference", args=args, kwargs={}
+    )
+    content_type, content_encoding, body = dumps(message.body, serializer="json")
+    if isinstance(body, str):
+        body = body.encode(content_encoding)
+    with Connection("memory://") as connection:
+        channel = connection.default_channel
+        prepared = channel.prepare_message(
+            body,
+            None,
+            content_type,
+            content_encoding,
+            message.headers,
+            {**message.properties, "delivery_mode": 2},
+        )
+        channel.basic_publish(prepared, "", "priority")
+        # The Redis transport stores messages as JSON, like send_task.
+        expected = json.loads(json.dumps(channel._get("priority")))
+
+    for published in (envelope, expected):
+        del published["properties"]["delivery_tag"]
+    assert queue == "priority"
+    assert envelope == expected
+
+
 def test_generate_endpoint_svamp(client):
     """
     Tests inference on svamp
@@ -70,6 +125,102 @@ def test_generate_endpoint_svamp(client):
     assert answer == 14
 
 
+def test_generate_stream_svamp(client):
+    """
+    Tests streaming inference on svamp
+    """
+    events = []
+    with client.stream(
+        "POST",
+        "/generate_stream",
+        json={
+            "model_name": "svamp",
+            "prompt": "A spider has 8 legs. A fly has 6 legs. How many legs do they have in total?\nAnswer:",
+            "max_new_tokens": 50,
+            "temperature": 0.7,
+        },
+    ) as response:
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+
+        event = None
+        for line in response.iter_lines():
+            if line.startswith("event: "):
+                event = line[len("event: ") :]
+            elif line.startswith("data: "):
+                events.append((event, json.loads(line[len("data: ") :])))
+
+    assert events[0][0] == "task"
+    assert "task_id" in events[0][1]
+    assert any(event == "token" for event, _ in events)
+
+    event, data = events[-1]
+    assert event == "done"
+    streamed = "".join(d["text"] for e, d in events if e == "token")
+    assert data["response"].endswith(streamed.strip())
+    assert get_final_answer(data["response"]) == 14
+
+
+def test_generate_greedy_requests_share_a_task(client):
+    """
+    Tests that identical greedy requests attach to one task, running or done
+    """
+    body = {
+        "model_name": "svamp",
+        "prompt": "A spider has 8 legs. A fly has 6 legs. How many legs do they have in total?\nAnswer:",
+        "max_new_tokens": 20,
+        "temperature": 0.0,
+    }
+    first = client.post("/generate", json=body).json()["task_id"]
+    second = client.post("/generate", json=body).json()["task_id"]
+    assert first == second
+
+    result = await_task_completion(client, first)
+    assert get_final_answer(result["response"]) == 14
+
+    assert client.post("/generate", json=body).json()["task_id"] == first
+    other = client.post("/generate", json=dict(body, max_new_tokens=21)).json()
+    assert other["task_id"] != first
+
+
+def test_generate_replaces_a_lost_shared_task(client):
+    """
+    Tests that a claimed task that was never queued is not shared
+    """
+    body = {
+        "model_name": "svamp",
+        "prompt": "Answer:",
+        "max_new_tokens": 2,
+        "temperature": 0.0,
+    }
+    key = response_key(
+        recipe_hash(base_model_recipe("svamp")), body["prompt"], body["max_new_tokens"]
+    )
+    # Claimed a minute ago by a request that never queued its task.
+    redis_client.set(key, "lost-task", ex=RESPONSE_CACHE_TTL_SECONDS - 60)
+
+    task_id = client.post("/generate", json=body).json()["task_id"]
+    assert task_id != "lost-task"
+    assert redis_client.get(key) == task_id
+    await_task_completion(client, task_id)
+
+
+def test_recipe_lookup_refreshes_every_recipe_of_the_session():
+    """
+    Tests that using one model keeps the session's other recipes alive
+    """
+    session_id = str(uuid.uuid4())
+    recipe_ids = [str(uuid.uuid4()) for _ in range(2)]
+    redis_client.hset(
+        session_key(session_id), mapping={"a_0": recipe_ids[0], "b_0": recipe_ids[1]}
+    )
+    for recipe_id in recipe_ids:
+        redis_client.set(recipe_key(recipe_id), json.dumps({"id": recipe_id}), ex=5)
+
+    assert get_model_recipe(session_id, "a_0") == {"id": recipe_ids[0]}
+    assert redis_client.ttl(recipe_key(recipe_ids[1])) > 5
+
+
 def test_merge_then_inference_svamp_1(client):
     """
     Tests merging then inference for svamp dataset
@@ -89,11 +240,7 @@ def test_merge_then_inference_svamp_1(client):
 
     assert merge_response.status_code == 200
     merge_data = merge_response.json()
-    assert "task_id" in merge_data
-    merge_task_id = merge_data["task_id"]
-
-    merge_status_data = await_task_completion(client, merge_task_id)
-    model_name = merge_status_data["response"]
+    model_name = merge_data["response"]
 
     time.sleep(5)
 
@@ -140,12 +287,7 @@ def test_merge_then_inference_svamp_2(client):
 
     assert merge_repsonse.status_code == 200
     merge_data = merge_repsonse.json()
-    assert "task_id" in merge_data
-    merge_task_id = merge_data["task_id"]
-
-    merge_status_data = await_task_completion(client, merge_task_id)
-
-    model_name = merge_status_data["response"]
+    model_name = merge_data["response"]
 
     merge_response2 = client.post(
         "/merge",
@@ -161,10 +303,7 @@ def test_merge_then_inference_svamp_2(client):
 
     assert merge_response2.status_code == 200
     merge_data2 = merge_response2.json()
-    assert "task_id" in merge_data2
-    merge_task_id2 = merge_data2["task_id"]
-    merge_status_data2 = await_task_completion(client, merge_task_id2)
-    model_name2 = merge_status_data2["response"]
+    model_name2 = merge_data2["response"]
 
     time.sleep(5)
 
@@ -212,10 +351,7 @@ def test_merge_two_children_then_merge(client):
 
     assert merge_response1.status_code == 200
     merge_data1 = merge_response1.json()
-    assert "task_id" in merge_data1
-    merge_task_id1 = merge_data1["task_id"]
-    merge_status_data1 = await_task_completion(client, merge_task_id1)
-    child1_name = merge_status_data1["response"]
+    child1_name = merge_data1["response"]
 
     merge_response2 = client.post(
         "/merge",
@@ -232,10 +368,7 @@ def test_merge_two_children_then_merge(client):
 
     assert merge_response2.status_code == 200
     merge_data2 = merge_response2.json()
-    assert "task_id" in merge_data2
-    merge_task_id2 = merge_data2["task_id"]
-    merge_status_data2 = await_task_completion(client, merge_task_id2)
-    child2_name = merge_status_data2["response"]
+    child2_name = merge_data2["response"]
 
     merge_response3 = client.post(
         "/merge",
@@ -251,10 +384,7 @@ def test_merge_two_children_then_merge(client):
 
     assert merge_response3.status_code == 200
     merge_data3 = merge_response3.json()
-    assert "task_id" in merge_data3
-    merge_task_id3 = merge_data3["task_id"]
-    merge_status_data3 = await_task_completion(client, merge_task_id3)
-    final_model_name = merge_status_data3["response"]
+    final_model_name = merge_data3["response"]
 
     time.sleep(5)
 
@@ -262,13 +392,8 @@ def test_merge_two_children_then_merge(client):
 
     assert number_of_models.status_code == 200
     number_of_models_data = number_of_models.json()
-    assert "task_id" in number_of_models_data
-    number_of_models_task_id = number_of_models_data["task_id"]
-
-    number_of_models_result = await_task_completion(client, number_of_models_task_id)
-
-    assert "response" in number_of_models_result
-    models = number_of_models_result["response"]
+    assert "response" in number_of_models_data
+    models = number_of_models_data["response"]
     print(models)
     assert len(models) == 5
 
@@ -313,12 +438,137 @@ def test_merge_fail(client):
         },
     )
 
-    assert merge_repsonse.status_code == 200
-    merge_data = merge_repsonse.json()
-    assert "task_id" in merge_data
-    merge_task_id = merge_data["task_id"]
+    assert merge_repsonse.status_code == 400
+    assert "Layer recipe too long" in merge_repsonse.json()["detail"]
+
+
+def test_generate_limits_requests_per_session(client):
+    """
+    Tests that a session over its in-flight limit is told when to retry
+    """
+    body = {
+        "model_name": "tinystories",
+        "prompt": "Once upon a time",
+        "max_new_tokens": 200,
+        "temperature": 0.7,
+    }
+    responses = [client.post("/generate", json=body) for _ in range(3)]
+
+    assert [r.status_code for r in responses[:2]] == [200, 200]
+    assert responses[2].status_code == 429
+    assert int(responses[2].headers["Retry-After"]) >= 1
+
+    for response in responses[:2]:
+        await_task_completion(client, response.json()["task_id"], timeout=120)
+    assert client.post("/generate", json=body).status_code == 200
+
+
+def test_cancel_task(client):
+    """
+    Tests that a cancelled generation stops and is reported as revoked
+    """
+    response = client.post(
+        "/generate",
+        json={
+            "model_name": "tinystories",
+            "prompt": "Once upon a time",
+            "max_new_tokens": 512,
+            "temperature": 0.7,
+        },
+    )
+    assert response.status_code == 200
+    task_id = response.json()["task_id"]
+
+    assert client.delete(f"/tasks/{task_id}").status_code == 200
+    assert client.delete(f"/tasks/{task_id}").status_code == 404
+
+    status = None
+    start_time = time.time()
+    while status != "REVOKED" and time.time() - start_time < 60:
+        status = client.get(f"/tasks/{task_id}", params={"wait": 10}).json()["status"]
+    assert status == "REVOKED"
+
+
+def test_cancel_shared_task_keeps_it_for_other_requests(client):
+    """
+    Tests that one request dropping a shared greedy task does not cancel it
+    """
+    body = {
+        "model_name": "svamp",
+        "prompt": "A spider has 8 legs. A bee has 6 legs. How many legs do they have in total?\nAnswer:",
+        "max_new_tokens": 20,
+        "temperature": 0.0,
+    }
+    with TestClient(app) as other:
+        task_id = client.post("/generate", json=body).json()["task_id"]
+        assert other.post("/generate", json=body).json()["task_id"] == task_id
+
+        assert client.delete(f"/tasks/{task_id}").status_code == 200
+        result = await_task_completion(other, task_id)
+    assert get_final_answer(result["response"]) == 14
+
+
+def test_task_status_long_poll(client):
+    """
+    Tests that a long-poll returns as soon as the task finishes
+    """
+    response = client.post(
+        "/generate",
+        json={"model_name": "svamp", "prompt": "Answer:", "max_new_tokens": 1},
+    )
+    assert response.status_code == 200
+    task_id = response.json()["task_id"]
+
+    start_time = time.time()
+    status_response = client.get(f"/tasks/{task_id}", params={"wait": 30})
+    elapsed = time.time() - start_time
+
+    assert status_response.status_code == 200
+    assert status_response.json()["status"] == "SUCCESS"
+    assert elapsed < 30
+
+
+def test_task_status_long_poll_timeout(client):
+    """
+    Tests that a long-poll on an unknown task gives up after the wait
+    """
+    start_time = time.time()
+    status_response = client.get("/tasks/does-not-exist", params={"wait": 1})
+
+    assert status_response.status_code == 200
+    assert status_response.json()["status"] == "PENDING"
+    assert time.time() - start_time >= 1
+
+
+def test_ready(client):
+    """
+    Tests that a warm worker has announced itself
+    """
+    response = client.get("/ready")
+
+    assert response.status_code == 200
+    data = response.json()
+    assert data["ready"]
+    assert data["workers"] >= 1
+
+
+def test_clear_session(client):
+    """
+    Tests that clearing a session leaves only the base models
+    """
+    merge_response = client.post(
+        "/merge",
+        json={
+            "model1_name": "svamp",
+            "model2_name": "tinystories",
+            "layer_recipe": [[(i, 0, 1.0)] for i in range(24)],
+            "merged_name": "cleared",
+        },
+    )
+    assert merge_response.status_code == 200
+
+    clear_response = client.post("/clear_session")
+    assert clear_response.status_code == 200
 
-    merge_status_data = await_task_completion(client, merge_task_id)
-    assert "response" not in merge_status_data
-    assert "error" in merge_status_data
-    assert "Layer recipe too long" in merge_status_data["error"]
+    models = client.post("/list_models").json()["response"]
+    assert sorted(models) == ["svamp", "tinystories"]
@@ -89,11 +89,7 @@ def test_merge_then_inference_svamp_1(session):
 
     assert merge_response.status_code == 200
     merge_data = merge_response.json()
-    assert "task_id" in merge_data
-    merge_task_id = merge_data["task_id"]
-
-    merge_status_data = await_task_completion(session, merge_task_id)
-    model_name = merge_status_data["response"]
+    model_name = merge_data["response"]
 
     time.sleep(5)
 
@@ -140,12 +136,7 @@ def test_merge_then_inference_svamp_2(session):
 
     assert merge_repsonse.status_code == 200
     merge_data = merge_repsonse.json()
-    assert "task_id" in merge_data
-    merge_task_id = merge_data["task_id"]
-
-    merge_status_data = await_task_completion(session, merge_task_id)
-
-    model_name = merge_status_data["response"]
+    model_name = merge_data["response"]
 
     merge_response2 = session.post(
         f"{BASE_URL}/merge",
@@ -161,10 +152,7 @@ def test_merge_then_inference_svamp_2(session):
 
     assert merge_response2.status_code == 200
     merge_data2 = merge_response2.json()
-    assert "task_id" in merge_data2
-    merge_task_id2 = merge_data2["task_id"]
-    merge_status_data2 = await_task_completion(session, merge_task_id2)
-    model_name2 = merge_status_data2["response"]
+    model_name2 = merge_data2["response"]
 
     time.sleep(5)
 
@@ -212,10 +200,7 @@ def test_merge_two_children_then_merge(session):
 
     assert merge_response1.status_code == 200
     merge_data1 = merge_response1.json()
-    assert "task_id" in merge_data1
-    merge_task_id1 = merge_data1["task_id"]
-    merge_status_data1 = await_task_completion(session, merge_task_id1)
-    child1_name = merge_status_data1["response"]
+    child1_name = merge_data1["response"]
 
     merge_response2 = session.post(
         f"{BASE_URL}/merge",
@@ -232,10 +217,7 @@ def test_merge_two_children_then_merge(session):
 
     assert merge_response2.status_code == 200
     merge_data2 = merge_response2.json()
-    assert "task_id" in merge_data2
-    merge_task_id2 = merge_data2["task_id"]
-    merge_status_data2 = await_task_completion(session, merge_task_id2)
-    child2_name = merge_status_data2["response"]
+    child2_name = merge_data2["response"]
 
     merge_response3 = session.post(
         f"{BASE_URL}/merge",
@@ -251,10 +233,7 @@ def test_merge_two_children_then_merge(session):
 
     assert merge_response3.status_code == 200
     merge_data3 = merge_response3.json()
-    assert "task_id" in merge_data3
-    merge_task_id3 = merge_data3["task_id"]
-    merge_status_data3 = await_task_completion(session, merge_task_id3)
-    final_model_name = merge_status_data3["response"]
+    final_model_name = merge_data3["response"]
 
     time.sleep(5)
 
@@ -262,13 +241,8 @@ def test_merge_two_children_then_merge(session):
 
     assert number_of_models.status_code == 200
     number_of_models_data = number_of_models.json()
-    assert "task_id" in number_of_models_data
-    number_of_models_task_id = number_of_models_data["task_id"]
-
-    number_of_models_result = await_task_completion(session, number_of_models_task_id)
-
-    assert "response" in number_of_models_result
-    models = number_of_models_result["response"]
+    assert "response" in number_of_models_data
+    models = number_of_models_data["response"]
     print(models)
     assert len(models) == 5
 
@@ -313,12 +287,5 @@ def test_merge_fail(session):
         },
     )
 
-    assert merge_repsonse.status_code == 200
-    merge_data = merge_repsonse.json()
-    assert "task_id" in merge_data
-    merge_task_id = merge_data["task_id"]
-
-    merge_status_data = await_task_completion(session, merge_task_id)
-    assert "response" not in merge_status_data
-    assert "error" in merge_status_data
-    assert "Layer recipe too long" in merge_status_data["error"]
+    assert merge_repsonse.status_code == 400
+    assert "Layer recipe too long" in merge_repsonse.json()["detail"]
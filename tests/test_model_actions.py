@@ -1,15 +1,50 @@
+import os
+import threading
+
+import pytest
 import torch
-from transformers import AutoModelForCausalLM
+from safetensors.torch import load_file
+from transformers import AutoModelForCausalLM, GPT2Config, GPT2LMHeadModel
 import re
 
+from evolutiontransformer import worker
+from evolutiontransformer.cache import BlockCache, DiskCache, ModelCache, model_nbytes
+from evolutiontransformer.quantize import quantize_model, upcast_model
+from evolutiontransformer.store import (
+    DeltaStack,
+    LayerStack,
+    export_base_store,
+    export_delta_store,
+    load_base_store,
+    read_metadata,
+    save_child_store,
+    save_file_streaming,
+)
 
 from evolutiontransformer.worker import (
     load_base_models_if_needed,
     BASE_MODELS,
+    MERGED_CACHE,
+    MODEL_CACHE,
+    StopWhenCancelled,
+    export_merged_model,
+    PREFIX_CACHE,
+    get_merged_model,
+    get_tokenizer,
     inference,
+    inference_batch,
     inference_task,
+    load_merged_model,
     merge_models,
+    merged_cache_key,
 )
+from evolutiontransformer.recipes import canonicalize_recipe, recipe_hash
+
+
+@pytest.fixture(autouse=True)
+def merged_cache_dir(tmp_path, monkeypatch):
+    # Children one test merges must not be mapped back from disk by another.
+    monkeypatch.setattr(MERGED_CACHE, "directory", str(tmp_path / "merged"))
 
 
 def get_final_answer(text: str) -> int | None:
@@ -81,3 +116,532 @@ def test_merge_models_with_inference2():
             "A spider has 8 legs. A fly has 6 legs. How many legs do they have in total?\nAnswer:",
         )
     )
+
+
+def test_merged_model_cache():
+    load_base_models_if_needed()
+    MODEL_CACHE.clear()
+
+    model_recipe = {
+        "layer_recipe": [
+            [(i, "svamp", 0.5), (i, "tinystories", 0.5)] for i in range(24)
+        ],
+        "embedding_lambdas": [0.5, 0.5],
+        "linear_lambdas": [0.5, 0.5],
+    }
+
+    hits = MODEL_CACHE.hits
+    first = get_merged_model(model_recipe)
+    second = get_merged_model(
+        {
+            "layer_recipe": [
+                [list(t) for t in layer] for layer in model_recipe["layer_recipe"]
+            ],
+            "embedding_lambdas": [0.5, 0.5],
+            "linear_lambdas": [0.5, 0.5],
+        }
+    )
+
+    assert first is second
+    assert MODEL_CACHE.hits == hits + 1
+
+
+def test_merge_models_aliases_identity_layers():
+    load_base_models_if_needed()
+
+    model_recipe = {
+        "layer_recipe": [[(i, "svamp", 1.0)] for i in range(24)],
+        "embedding_lambdas": [1.0, 1.0],
+        "linear_lambdas": [1.0, 1.0],
+    }
+
+    merged_model = merge_models(model_recipe)
+
+    for (name1, param1), (name2, param2) in zip(
+        BASE_MODELS["svamp"].named_parameters(), merged_model.named_parameters()
+    ):
+        assert param1.data_ptr() == param2.data_ptr()
+    assert MODEL_CACHE.sizeof(merged_model) < model_nbytes(BASE_MODELS["svamp"]) // 10
+
+
+def test_inference_batch():
+    load_base_models_if_needed()
+
+    model = get_merged_model(
+        {
+            "layer_recipe": [[(i, "svamp", 1.0)] for i in range(24)],
+            "embedding_lambdas": [1.0, 1.0],
+            "linear_lambdas": [1.0, 1.0],
+        }
+    )
+
+    outputs = inference_batch(
+        model,
+        [
+            (
+                "If there are 3 cars and 2 bikes, how many vehicles are there in total?\nAnswer:",
+                50,
+                0.0,
+            ),
+            (
+                "A spider has 8 legs. A fly has 6 legs. How many legs do they have in total?\nAnswer:",
+                20,
+                0.0,
+            ),
+        ],
+    )
+
+    assert get_final_answer(outputs[0]) == 5
+    assert get_final_answer(outputs[1]) == 14
+
+
+def test_inference_batch_stops_cancelled_rows(monkeypatch):
+    load_base_models_if_needed()
+    monkeypatch.setattr(worker, "is_task_cancelled", lambda task_id: task_id == "a")
+
+    model = get_merged_model(
+        {
+            "layer_recipe": [[(i, "tinystories", 1.0)] for i in range(24)],
+            "embedding_lambdas": [0.0, 0.0],
+            "linear_lambdas": [0.0, 0.0],
+        }
+    )
+    tokenizer = get_tokenizer()
+    prompt = "Once upon a time"
+    outputs = inference_batch(
+        model,
+        [(prompt, 64, 0.0), (prompt, 64, 0.0)],
+        [StopWhenCancelled("a", every=1), StopWhenCancelled("b", every=1)],
+    )
+
+    lengths = [len(tokenizer(output)["input_ids"]) for output in outputs]
+    assert lengths[0] <= len(tokenizer(prompt)["input_ids"]) + 1
+    assert lengths[1] > lengths[0]
+
+
+def test_tokenizer_is_per_thread():
+    prompts = ["A short prompt", "A somewhat longer prompt than that"]
+    errors = []
+
+    def encode():
+        try:
+            for _ in range(50):
+                get_tokenizer()(prompts, return_tensors="pt", padding=True)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=encode) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    other = []
+    thread = threading.Thread(target=lambda: other.append(get_tokenizer()))
+    thread.start()
+    thread.join()
+    assert other[0] is not get_tokenizer()
+
+
+def test_inference_reuses_prompt_prefix():
+    load_base_models_if_needed()
+
+    model = get_merged_model(
+        {
+            "layer_recipe": [[(i, "svamp", 1.0)] for i in range(24)],
+            "embedding_lambdas": [1.0, 1.0],
+            "linear_lambdas": [1.0, 1.0],
+        }
+    )
+    few_shot = (
+        "There are 4 apples and 3 pears. How many fruits are there?\nAnswer: 7\n"
+        "A box has 5 red and 6 blue balls. How many balls are in it?\nAnswer: 11\n"
+    )
+    prompt = few_shot + "If there are 3 cars and 2 bikes, how many vehicles are there in total?\nAnswer:"
+
+    PREFIX_CACHE.clear()
+    expected = inference(model, prompt, 20, 0.0)
+
+    inference(model, few_shot + "Hello\nAnswer:", 5, 0.0, recipe_key="prefix-test")
+    hits = PREFIX_CACHE.hits
+    output = inference(model, prompt, 20, 0.0, recipe_key="prefix-test")
+
+    assert PREFIX_CACHE.hits == hits + 1
+    assert output == expected
+
+
+SVAMP_PROMPTS = [
+    ("If there are 3 cars and 2 bikes, how many vehicles are there in total?\nAnswer:", 5),
+    ("A spider has 8 legs. A fly has 6 legs. How many legs do they have in total?\nAnswer:", 14),
+]
+
+
+def test_quantized_model_accuracy():
+    load_base_models_if_needed()
+
+    model = get_merged_model(
+        {
+            "layer_recipe": [[(i, "svamp", 1.0)] for i in range(24)],
+            "embedding_lambdas": [1.0, 1.0],
+            "linear_lambdas": [1.0, 1.0],
+        }
+    )
+    quantized = quantize_model(model)
+
+    fp32_correct = int8_correct = 0
+    for prompt, answer in SVAMP_PROMPTS:
+        fp32_correct += get_final_answer(inference(model, prompt, 50, 0.0)) == answer
+        int8_correct += get_final_answer(inference(quantized, prompt, 50, 0.0)) == answer
+    print(f"SVAMP accuracy fp32={fp32_correct} int8={int8_correct} of {len(SVAMP_PROMPTS)}")
+
+    assert int8_correct == fp32_correct
+    # int8 block weights take about a quarter of the fp32 ones.
+    fp32_bytes = model_nbytes(model.transformer.h)
+    assert model_nbytes(quantized.transformer.h) < fp32_bytes / 3
+
+
+def test_bf16_merge_accumulates_in_fp32():
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2)
+    model = GPT2LMHeadModel(config).to(torch.bfloat16).eval()
+    stack = LayerStack(["svamp"], model.transformer.h[0], 2, torch.bfloat16)
+    stack.pack("svamp", model)
+
+    # Eight tenths of the same layer, rounded to bf16 once rather than per term.
+    (merged,) = stack.merge_layers([[(0, "svamp", 0.1)] * 8])
+    expected = stack.layer("svamp", 0).float() * 0.8
+
+    assert merged.dtype == torch.bfloat16
+    torch.testing.assert_close(merged.float(), expected, atol=1e-6, rtol=2**-8)
+
+
+def test_upcast_model_leaves_bf16_child_untouched():
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2)
+    model = GPT2LMHeadModel(config).to(torch.bfloat16).eval()
+    upcast = upcast_model(model)
+
+    assert model.dtype == torch.bfloat16
+    assert upcast.dtype == torch.float32
+    assert upcast.lm_head.weight is upcast.transformer.wte.weight
+    input_ids = torch.randint(0, config.vocab_size, (1, 8))
+    with torch.no_grad():
+        torch.testing.assert_close(
+            upcast(input_ids).logits,
+            model(input_ids).logits.float(),
+            atol=0.1,
+            rtol=0.05,
+        )
+
+
+def test_delta_store_merges_like_full_parents(tmp_path):
+    torch.manual_seed(0)
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2)
+    base = GPT2LMHeadModel(config).eval()
+    parents = {}
+    for name in ["svamp", "tinystories"]:
+        parent = GPT2LMHeadModel(config).eval()
+        parent.load_state_dict(base.state_dict())
+        with torch.no_grad():
+            # A rank-one change to one weight, as a fine-tune might make.
+            attn = parent.transformer.h[1].attn.c_attn.weight
+            attn += torch.outer(torch.randn(attn.shape[0]), torch.randn(attn.shape[1]))
+        parents[name] = parent
+
+    full = LayerStack(list(parents), base.transformer.h[0], 2)
+    for name, parent in parents.items():
+        full.pack(name, parent)
+
+    path = str(tmp_path / "delta.safetensors")
+    export_delta_store(path, base, parents, rank=1)
+    stack, models = load_base_store(path)
+
+    assert isinstance(stack, DeltaStack)
+    assert set(stack.deltas["svamp"][1]) == {"attn.c_attn.weight"}
+    assert isinstance(stack.deltas["svamp"][1]["attn.c_attn.weight"], tuple)
+    recipe = [[(1, "svamp", 0.3), (0, "tinystories", 0.7)], [(1, "tinystories", 1.0)]]
+    for merged, expected in zip(stack.merge_layers(recipe), full.merge_layers(recipe)):
+        torch.testing.assert_close(merged, expected, atol=1e-4, rtol=1e-4)
+
+
+def test_compressed_delta_store_is_smaller_than_full_store(tmp_path):
+    torch.manual_seed(0)
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2)
+    base = GPT2LMHeadModel(config).eval()
+    parents = {}
+    for name in ["svamp", "tinystories"]:
+        parent = GPT2LMHeadModel(config).eval()
+        parent.load_state_dict(base.state_dict())
+        with torch.no_grad():
+            # Rank-one changes to the embeddings and every block weight.
+            for param in [parent.transformer.wte.weight] + [
+                p for p in parent.transformer.h.parameters() if p.dim() == 2
+            ]:
+                param += torch.outer(
+                    torch.randn(param.shape[0]), torch.randn(param.shape[1])
+                )
+        parents[name] = parent
+
+    full_path = str(tmp_path / "full.safetensors")
+    delta_path = str(tmp_path / "delta.safetensors")
+    export_base_store(full_path, parents)
+    export_delta_store(delta_path, base, parents, rank=1)
+
+    # The base plus small factors, against two full parents.
+    assert os.path.getsize(delta_path) < 0.6 * os.path.getsize(full_path)
+    _, models = load_base_store(delta_path)
+    for name, parent in parents.items():
+        torch.testing.assert_close(
+            models[name].transformer.wte.weight,
+            parent.transformer.wte.weight,
+            atol=1e-4,
+            rtol=1e-4,
+        )
+    # Unchanged weights are the base's, shared by both parents.
+    assert (
+        models["svamp"].transformer.wpe.weight.data_ptr()
+        == models["tinystories"].transformer.wpe.weight.data_ptr()
+    )
+
+
+def test_get_merged_model_remerges_only_changed_layers():
+    load_base_models_if_needed()
+
+    recipe = {
+        "layer_recipe": [[(i, "svamp", 0.5), (i, "tinystories", 0.5)] for i in range(24)],
+        "embedding_lambdas": [0.5, 0.5],
+        "linear_lambdas": [0.5, 0.5],
+    }
+    edited = dict(
+        recipe,
+        layer_recipe=recipe["layer_recipe"][:23] + [[(23, "svamp", 0.9)]],
+    )
+
+    original = get_merged_model(recipe)
+    remerged = get_merged_model(edited)
+    full = merge_models(edited)
+
+    original_params = dict(original.named_parameters())
+    full_params = dict(full.named_parameters())
+    for name, param in remerged.named_parameters():
+        torch.testing.assert_close(param, full_params[name])
+        if name.startswith("transformer.h.23."):
+            assert param.data_ptr() != original_params[name].data_ptr()
+        else:
+            assert param.data_ptr() == original_params[name].data_ptr()
+
+
+def test_block_cache_evicts_only_unreferenced_blocks():
+    cache = BlockCache(max_bytes=4 * 10)
+    a = cache.acquire("a", lambda: torch.zeros(10))
+    assert cache.acquire("a", lambda: torch.ones(10)) is a
+    cache.acquire("b", lambda: torch.zeros(10))
+
+    cache.release(["a"])
+    cache.release(["b"])
+    # One idle block fits the budget, so releasing "c" evicts "b"; "a" is still
+    # referenced and never a candidate.
+    cache.acquire("c", lambda: torch.zeros(10))
+    cache.release(["c"])
+
+    assert cache.acquire("a", lambda: torch.ones(10)) is a
+    assert cache.evictions == 1
+    assert len(cache) == 2
+
+
+def test_model_cache_bounds_shared_blocks():
+    base = torch.zeros(100)
+    blocks = [torch.zeros(100) for _ in range(3)]
+
+    def child(*tensors):
+        model = torch.nn.Module()
+        for i, tensor in enumerate(tensors):
+            model.register_buffer(f"t{i}", tensor)
+        return model
+
+    cache = ModelCache(
+        max_bytes=4 * 250,
+        shared_storage=lambda: {base.untyped_storage().data_ptr()},
+    )
+    cache.put("a", child(base, blocks[0], blocks[1]))
+    # Shares both blocks with "a", so it adds nothing to the total.
+    cache.put("b", child(base, blocks[1], blocks[0]))
+    assert len(cache) == 2
+    assert cache.stats()["bytes"] == 4 * 200
+
+    # Evicting "a" alone frees nothing while "b" holds the same blocks.
+    cache.put("c", child(base, blocks[2]))
+    assert "a" not in cache and "b" not in cache
+    assert cache.stats()["bytes"] == 4 * 100
+
+    cache.put("d", child(*blocks))
+    assert cache.stats()["bytes"] <= cache.max_bytes
+    assert "d" not in cache
+
+
+def test_children_share_merged_blocks():
+    load_base_models_if_needed()
+
+    shared = [(5, "svamp", 0.5), (5, "tinystories", 0.5)]
+    model1 = merge_models(
+        {
+            "layer_recipe": [shared] * 3 + [[(i, "svamp", 1.0)] for i in range(3, 24)],
+            "embedding_lambdas": [1.0, 1.0],
+            "linear_lambdas": [1.0, 1.0],
+        }
+    )
+    model2 = merge_models(
+        {
+            "layer_recipe": [[(i, "tinystories", 0.7)] for i in range(23)] + [shared],
+            "embedding_lambdas": [0.0, 0.0],
+            "linear_lambdas": [0.0, 0.0],
+        }
+    )
+
+    ptr = model1.transformer.h[0].mlp.c_fc.weight.data_ptr()
+    assert model1.transformer.h[2].mlp.c_fc.weight.data_ptr() == ptr
+    assert model2.transformer.h[23].mlp.c_fc.weight.data_ptr() == ptr
+
+
+def test_save_file_streaming_matches_safetensors(tmp_path):
+    tensors = {
+        "a": torch.randn(3, 5),
+        "b": torch.randn(7).to(torch.bfloat16),
+        "c": torch.arange(4, dtype=torch.int64),
+    }
+    path = str(tmp_path / "streamed.safetensors")
+    specs = [(key, tensor.dtype, tensor.shape) for key, tensor in tensors.items()]
+    save_file_streaming(path, specs, iter(tensors.values()), {"format": "pt"})
+
+    loaded = load_file(path)
+    assert list(loaded) == list(tensors)
+    for key, tensor in tensors.items():
+        assert torch.equal(loaded[key], tensor)
+
+
+def test_export_merged_model_loads_with_from_pretrained(tmp_path):
+    load_base_models_if_needed()
+
+    recipe = {
+        "layer_recipe": [[(i, "svamp", 0.6), (i, "tinystories", 0.4)] for i in range(4)]
+        + [[(i, "tinystories", 1.0)] for i in range(20)],
+        "embedding_lambdas": [0.3, 0.7],
+        "linear_lambdas": [0.2, 0.8],
+    }
+    export_merged_model(recipe, str(tmp_path))
+    exported = AutoModelForCausalLM.from_pretrained(str(tmp_path))
+    merged = merge_models(recipe)
+
+    merged_params = dict(merged.named_parameters())
+    for name, param in exported.named_parameters():
+        torch.testing.assert_close(param, merged_params[name])
+
+
+def test_export_is_redone_for_another_base_store(tmp_path, monkeypatch):
+    load_base_models_if_needed()
+    monkeypatch.setattr(worker, "EXPORT_DIR", str(tmp_path))
+
+    result = worker.export_task("session", "svamp")["response"]
+    model_file = os.path.join(result["path"], "model.safetensors")
+    first = os.stat(model_file).st_mtime_ns
+    worker.export_task("session", "svamp")
+    assert os.stat(model_file).st_mtime_ns == first
+
+    monkeypatch.setattr(worker, "BASE_STORE_ID", "another-export")
+    worker.export_task("session", "svamp")
+    assert read_metadata(model_file)["base"] == worker.base_store_key()
+    assert os.stat(model_file).st_mtime_ns != first
+
+
+def test_merged_model_loads_from_disk_after_restart():
+    load_base_models_if_needed()
+
+    recipe = canonicalize_recipe(
+        {
+            "layer_recipe": [[(i, "svamp", 0.5), (i, "tinystories", 0.5)] for i in range(2)]
+            + [[(i, "svamp", 1.0)] for i in range(2, 24)],
+            "embedding_lambdas": [0.5, 0.5],
+            "linear_lambdas": [0.5, 0.5],
+        }
+    )
+    key = recipe_hash(recipe)
+    merged = merge_models(recipe)
+    MERGED_CACHE.put(
+        merged_cache_key(key),
+        lambda path: save_child_store(path, merged, worker.LAYER_STACK, recipe),
+    )
+
+    loaded = load_merged_model(key)
+
+    assert loaded is not None
+    assert loaded.merge_recipe == recipe
+    merged_params = dict(merged.named_parameters())
+    for name, param in loaded.named_parameters():
+        torch.testing.assert_close(param, merged_params[name])
+    # Pure-copy layers alias the parents again rather than being stored.
+    assert (
+        loaded.transformer.h[5].mlp.c_fc.weight.data_ptr()
+        == BASE_MODELS["svamp"].transformer.h[5].mlp.c_fc.weight.data_ptr()
+    )
+
+
+def test_disk_loaded_child_shares_blocks_with_later_merges():
+    load_base_models_if_needed()
+
+    shared = [(3, "svamp", 0.3), (3, "tinystories", 0.7)]
+    recipe = canonicalize_recipe(
+        {
+            "layer_recipe": [shared] + [[(i, "svamp", 1.0)] for i in range(1, 24)],
+            "embedding_lambdas": [1.0, 1.0],
+            "linear_lambdas": [1.0, 1.0],
+        }
+    )
+    key = recipe_hash(recipe)
+    merged = merge_models(recipe)
+    MERGED_CACHE.put(
+        merged_cache_key(key),
+        lambda path: save_child_store(path, merged, worker.LAYER_STACK, recipe),
+    )
+    del merged
+
+    loaded = load_merged_model(key)
+    other = merge_models(
+        {
+            "layer_recipe": [[(i, "tinystories", 1.0)] for i in range(23)] + [shared],
+            "embedding_lambdas": [0.0, 0.0],
+            "linear_lambdas": [0.0, 0.0],
+        }
+    )
+
+    assert (
+        other.transformer.h[23].mlp.c_fc.weight.data_ptr()
+        == loaded.transformer.h[0].mlp.c_fc.weight.data_ptr()
+    )
+
+
+def test_merged_cache_key_depends_on_base_store(monkeypatch):
+    keys = [merged_cache_key("abc")]
+    monkeypatch.setattr(worker, "BASE_STORE_ID", "another-export")
+    keys.append(merged_cache_key("abc"))
+    monkeypatch.setattr(worker, "BASE_STORE_FORMAT", "delta")
+    keys.append(merged_cache_key("abc"))
+    monkeypatch.setattr(worker, "WEIGHT_DTYPE", torch.bfloat16)
+    keys.append(merged_cache_key("abc"))
+    assert len(set(keys)) == len(keys)
+
+
+def test_disk_cache_evicts_least_recently_used_files(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=25, suffix=".bin")
+
+    def write(path):
+        with open(path, "wb") as f:
+            f.write(b"x" * 10)
+
+    for i, key in enumerate(["a", "b"]):
+        cache.put(key, write)
+        os.utime(cache.path(key), (i, i))
+    assert cache.get("a") is not None
+    cache.put("c", write)
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.evictions == 1
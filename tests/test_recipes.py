@@ -0,0 +1,99 @@
+from evolutiontransformer.recipes import (
+    base_model_recipe,
+    canonicalize_layer,
+    canonicalize_recipe,
+    changed_parts,
+    merge_model_recipe,
+    recipe_hash,
+)
+
+
+def test_canonicalize_layer():
+    terms = [
+        (3, "tinystories", 0.25),
+        (1, "svamp", 0.1),
+        (3, "tinystories", 0.25),
+        (2, "svamp", 0.0),
+        (1, "svamp", 0.2),
+    ]
+
+    assert canonicalize_layer(terms) == [
+        [1, "svamp", 0.3],
+        [3, "tinystories", 0.5],
+    ]
+
+
+def test_canonicalize_layer_drops_cancelled_terms():
+    assert canonicalize_layer([(0, "svamp", 0.5), (0, "svamp", -0.5)]) == []
+
+
+def test_equivalent_recipes_hash_the_same():
+    recipe1 = {
+        "layer_recipe": [
+            [(0, "svamp", 0.5), (0, "tinystories", 0.5)],
+            [(1, "svamp", 1.0)],
+        ],
+        "embedding_lambdas": [1.0, 0.5],
+        "linear_lambdas": [1.0, 0.5],
+    }
+    recipe2 = {
+        "layer_recipe": [
+            [[0, "tinystories", 0.5], [0, "svamp", 0.2], [0, "svamp", 0.3]],
+            [[1, "svamp", 0.9999999999], [5, "tinystories", 0.0]],
+        ],
+        "embedding_lambdas": [1, 0.5],
+        "linear_lambdas": [1.0, 0.50000000001],
+    }
+
+    assert canonicalize_recipe(recipe1) == canonicalize_recipe(recipe2)
+    assert recipe_hash(recipe1) == recipe_hash(recipe2)
+
+
+def test_different_layer_order_hashes_differently():
+    recipe = {
+        "layer_recipe": [[(0, "svamp", 1.0)], [(1, "svamp", 1.0)]],
+        "embedding_lambdas": [1.0, 1.0],
+        "linear_lambdas": [1.0, 1.0],
+    }
+    swapped = dict(recipe, layer_recipe=recipe["layer_recipe"][::-1])
+
+    assert recipe_hash(recipe) != recipe_hash(swapped)
+
+
+def test_merge_model_recipe_expands_parents():
+    merged = merge_model_recipe(
+        base_model_recipe("svamp"),
+        base_model_recipe("tinystories"),
+        [[(0, 0, 0.5), (0, 1, 0.5)], [(3, 1, 1.0)]],
+        embedding_lambdas=[1.0, 0.25],
+        linear_lambdas=[0.0, 0.5],
+    )
+
+    assert canonicalize_recipe(merged) == {
+        "layer_recipe": [
+            [[0, "svamp", 0.5], [0, "tinystories", 0.5]],
+            [[3, "tinystories", 1.0]],
+        ],
+        "embedding_lambdas": [1.0, 1.0],
+        "linear_lambdas": [1.0, 1.0],
+    }
+
+
+def test_changed_parts():
+    old = {
+        "layer_recipe": [[(0, "svamp", 1.0)], [(1, "svamp", 0.5), (1, "tinystories", 0.5)]],
+        "embedding_lambdas": [1.0, 1.0],
+        "linear_lambdas": [1.0, 0.5],
+    }
+    new = {
+        "layer_recipe": [
+            [(0, "svamp", 1.0)],
+            [(1, "tinystories", 0.5), (1, "svamp", 0.5)],
+            [(2, "svamp", 1.0)],
+        ],
+        "embedding_lambdas": [1.0, 0.5],
+        "linear_lambdas": [1.0, 0.5],
+    }
+
+    assert changed_parts(old, new) == {"wpe", "h.2"}
+    assert changed_parts(new, new) == set()